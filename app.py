@@ -3,12 +3,19 @@ import numpy as np
 import pandas as pd
 import streamlit as st
 import datetime
-import gc
+import time
 
 from utils import plot
 from utils.acquire import download_coaching_sleep
+from utils.acquire import fleet_presence
+from utils.acquire import get_duplicate_stats, reset_duplicate_stats
 from utils import all_loc_ids
 from utils import all_plot_types
+from utils import connection
+from utils import caching
+from utils import compression
+from utils import views
+from utils import live
 
 from auth import hashes, pass_to_hash
 
@@ -63,34 +70,55 @@ def detail_functions():
         freq = st.selectbox("Choose how long time intervals shoud be:", 
             ["5min", "15min", "2h", "3h", "6h", "1d"], index=2)
         clips = True
+    decimate = True
+    if plot_type in ('plot bed sensor data', 'plot clip sensor data', 'plot walking'):
+        decimate = not st.checkbox("Full resolution (slow, for forensic views)")
+    if plot_type in ('plot bed sensor data', 'plot clip sensor data'):
+        if st.checkbox("Live tail (shows new packets as they arrive, uncheck to stop)"):
+            live_tail(loc_id, base, plot_type)
+            return
     plot_button = st.button('Plot!')
     if plot_button:
         element = st.text('Coming up!')
-        p = plot.make_figure(loc_id, start_date, end_date, base, plot_type, freq=freq, clip=True)
+        p = plot.render_figure(loc_id, start_date, end_date, base, plot_type, freq=freq, clip=True, decimate=decimate)
         element.empty()
-        st.pyplot(p)
+        st.image(p)
     else:
         pass
 
+def live_tail(loc_id, base, plot_type):
+    if plot_type == 'plot bed sensor data':
+        source_id = {"$regex": "sens_bed_accel_"}
+    else:
+        source_id = {"$regex": "_accel_"}
+    tail = live.LiveTail(loc_id, source_id, base)
+    figure = plot.LivePlot(tail, f"{loc_id} live magnitudes, {base} database")
+    status, image = st.empty(), st.empty()
+    started = time.time()
+    try:
+        while time.time() - started < live.MAX_DURATION.total_seconds():
+            added = tail.poll()
+            image.image(figure.update())
+            status.text(f"{added} new samples at {datetime.datetime.utcnow().strftime('%H:%M:%S')} UTC.")
+            time.sleep(live.POLL_INTERVAL.total_seconds())
+        status.text(f"Live tail stopped after {live.MAX_DURATION}, check the box again to resume.")
+    finally:
+        figure.close()
+
 def plot_week():
-    today = datetime.datetime.now().date()
-    today = datetime.datetime(
-        today.year, today.month, today.day, 12)
     c1, c2, c3 = st.beta_columns(3)
     with c1:
         loc_id = st.selectbox("Location ID:", all_loc_ids)
     with c2:
         base = st.radio('Database:', ('prod', "dev"))
-    start_date = today - datetime.timedelta(6)
-    timerange = [start_date + datetime.timedelta(i) for i in range(7)]
     with c3:
         plot_button = st.button('Plot!')
     if plot_button:
         element = st.text('Coming up!')
-        for start_date, end_date in zip(timerange[0:-1], timerange[1:]):
-            p = plot.make_figure(loc_id, start_date, end_date, base, 'plot bed sensor data')
+        for start_date, end_date in views.last_week():
+            p = plot.render_figure(loc_id, start_date, end_date, base, 'plot bed sensor data')
             element.empty()
-            st.pyplot(p)
+            st.image(p)
             try:
                 coachings = download_coaching_sleep(loc_id, start_date, end_date)
                 if coachings:
@@ -102,52 +130,48 @@ def plot_week():
                     st.write("No coaching found for this location and date.")
             except Exception as e:
                 st.write(f"Coaching querying raised an exception: {e}")
-            del p
-            gc.collect()
 def data_presence():
-    today = datetime.datetime.utcnow()
-    suggested_end_time = datetime.datetime(
-        today.year,
-        today.month,
-        today.day,
-        datetime.datetime.utcnow().hour)
-    start = suggested_end_time - datetime.timedelta(days=5)
+    start, today = views.data_presence()
     c1, c2, c3 = st.beta_columns(3)
     with c1:
-        prefix = st.radio("Which locations would you like to visualize?", ('AT', "BG", "SI"))
+        prefix = st.radio("Which locations would you like to visualize?", views.PREFIXES)
     with c2:
         base = st.radio('Database:', ('prod', "dev"))
-    loc_ids = [l for l in all_loc_ids if l.startswith(prefix)]
+    loc_ids = views.locations(prefix)
     with c3:
         plot_button = st.button('Plot!')
     if plot_button:
         element = st.text('Coming up!')
-        for loc_id in loc_ids:
-            p = plot.make_figure(loc_id, start, today, base, 'check data presence', freq="3h", clip=False)
+        # One scan for all locations drives the overview and the per location plots.
+        presence = fleet_presence(loc_ids, plot.PRESENCE_SOURCES, start, today, base, freq=views.PRESENCE_FREQ)
+        element.empty()
+        st.image(plot.figure_image(plot.draw_fleet(presence, base)))
+        for loc_id, p in plot.render_many(loc_ids, start, today, base, 'check data presence',
+                                          data=plot.split_fleet(presence), freq=views.PRESENCE_FREQ, clip=False):
             element.empty()
-            st.pyplot(p)
-            del p
-            gc.collect()
+            if isinstance(p, Exception):
+                st.write(f"Plotting {loc_id} raised an exception: {p}")
+            else:
+                st.image(p)
 
 def plot_day():
-    today = datetime.datetime.utcnow()
-    today = datetime.datetime(today.year, today.month, today.day, today.hour)
-    start = today - datetime.timedelta(days=1)
+    start, today = views.last_day()
     c1, c2, c3 = st.beta_columns(3)
     with c1:
-        prefix = st.radio("Which locations would you like to visualize?", ('AT', "BG", "SI"))
+        prefix = st.radio("Which locations would you like to visualize?", views.PREFIXES)
     with c2:
         base = st.radio('Database:', ('prod', "dev"))
-    loc_ids = [l for l in all_loc_ids if l.startswith(prefix)]
+    loc_ids = views.locations(prefix)
     with c3:
         plot_button = st.button('Plot!')
     if plot_button:
         element = st.text('Coming up!')
-        for loc_id in loc_ids:
-            p = plot.make_figure(loc_id, start, today, base, 'plot bed sensor data')
+        for loc_id, p in plot.render_many(loc_ids, start, today, base, 'plot bed sensor data'):
             element.empty()
-            st.pyplot(p)
-            del p
+            if isinstance(p, Exception):
+                st.write(f"Plotting {loc_id} raised an exception: {p}")
+            else:
+                st.image(p)
             try:
                 coachings = download_coaching_sleep(loc_id, start, today + datetime.timedelta(days=1))
                 if coachings:
@@ -159,17 +183,48 @@ def plot_day():
                     st.write("No coaching found for this location and date.")
             except Exception as e:
                 st.write(f"Coaching querying raised an exception: {e}")
-            gc.collect()
-def clear_cache():
-    import diskcache as dc
-    cache = dc.Cache("cache/")
-    start_size = cache.count
-    for key in cache.iterkeys():
-        try:
-            del cache[key]
-        except:
-            pass
-    st.write(f"Cleaned cache. Before: {start_size}, now {cache.count}")
+def cache_admin():
+    """Size of the cache namespaces and invalidation of their entries."""
+    for namespace, (size_limit, eviction_policy) in caching.NAMESPACES.items():
+        cache = caching.get_cache(namespace)
+        summary = caching.cache_summary(cache)
+        st.write(f"{namespace}: {len(cache)} entries "
+                 f"({summary.get(caching.SEALED, (0, 0))[0]} sealed, {summary.get(caching.LIVE, (0, 0))[0]} live), "
+                 f"{cache.volume() / 1e6:.0f} of {size_limit / 1e6:.0f} MB, eviction: {eviction_policy}")
+    compressed = compression.get_stats()
+    if compressed["ratio"] is not None:
+        st.write(f"Compression since start: {compressed['entries']} entries stored at ratio "
+                 f"{compressed['ratio']:.1f}, encoding {compressed['encode_mbps']:.0f} MB/s, "
+                 f"decoding {compressed['decode_mbps'] or 0:.0f} MB/s")
+
+    namespaces = st.multiselect("Invalidate namespaces:", list(caching.NAMESPACES),
+                                default=["downloads", "coaching", "renders"])
+    c1, c2 = st.beta_columns(2)
+    with c1:
+        base = st.selectbox("Of base:", ("all", "prod", "dev"))
+    with c2:
+        loc_id = st.selectbox("Of location:", ["all"] + all_loc_ids)
+    start = end = None
+    if st.checkbox("Only a period"):
+        c1, c2 = st.beta_columns(2)
+        with c1:
+            start_date = st.date_input('From:', datetime.date.today() - datetime.timedelta(days=1))
+        with c2:
+            end_date = st.date_input('To (excluded):', datetime.date.today())
+        start = datetime.datetime(start_date.year, start_date.month, start_date.day)
+        end = datetime.datetime(end_date.year, end_date.month, end_date.day)
+    if st.button("Invalidate"):
+        caching.invalidate_in_background(
+            namespaces, base=None if base == "all" else base, loc_id=None if loc_id == "all" else loc_id,
+            start=start, end=end)
+    for running, criteria, started in caching.invalidations():
+        st.write(f"Invalidating {', '.join(running)} ({criteria}) in the background "
+                 f"for {time.time() - started:.0f} s, the page can be used meanwhile.")
+
+    with st.beta_expander("Live cache entries"):
+        for namespace in ("downloads", "renders"):
+            for key, remaining in caching.live_entries(caching.get_cache(namespace)):
+                st.write(f"{key}: refreshed in {remaining:.0f} s")
 
 st.title('SAAM Data Plotter')
 
@@ -187,18 +242,10 @@ if logged_in:
 
 # Archival data can now be seamlessly plotted with the data on the currently active collections, thanks 
 #         for your patience. -Peter""")
-    import diskcache as dc
-    cache = dc.Cache("cache/")
+    connection.reset_stats()
+    reset_duplicate_stats()
     if user == 'peter':
-        c1, c2, c3 = st.beta_columns(3)
-        with c1:
-            but = st.button("Clear cache")
-            if but:
-                clear_cache()
-        with c2:
-            st.write(f"Current cache size: ", cache.size)
-        with c3:
-            st.write(f"Currenct cache count: ", cache.count)
+        cache_admin()
     c1, c2 = st.empty(), st.empty()
     logging.debug(f"Successful login for {user}.")
     c1, c2 = st.beta_columns(2)
@@ -223,6 +270,13 @@ Check 'detailed' to see what else is possible.""")
         plot_week()
     elif mode == "last day":
         plot_day()
+    if user == 'peter':
+        stats = connection.get_stats()
+        st.write(f"Database usage for this render: "
+                 f"{stats.get('round_trips', 0)} round trips, "
+                 f"{stats.get('connections_opened', 0)} new connections, "
+                 f"{stats.get('checkouts', 0)} pool checkouts, "
+                 f"{get_duplicate_stats().get('packets', 0)} duplicate packets dropped.")
 
 else:
     if (user != "") and (pswd != ""):
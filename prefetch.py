@@ -0,0 +1,106 @@
+"""Warms the download and render caches for the standard views of app.py
+("last day", "last week", "data presence"), so operators mostly hit the cache.
+
+Run next to the app, from the same directory:
+
+    python prefetch.py --every 60
+
+Every run renders the windows that are not closed yet anew and stores the
+images to last until the next run, while their downloads expire after
+caching.LIVE_TTL as usual. Every run is logged to ./prefetch.log."""
+import time
+import datetime
+import argparse
+import logging
+
+from utils import all_loc_ids
+from utils import plot
+from utils import views
+from utils import connection
+from utils import caching
+from utils import presence
+from utils.acquire import download_coaching_sleep
+from utils.acquire import fleet_presence
+
+VIEWS = ("day", "week", "presence")
+
+
+def jobs(view, base, prefixes):
+    """(description, function) pairs making the same calls as view in app.py."""
+    if view == "day":
+        start, end = views.last_day()
+        for prefix in prefixes:
+            for loc_id in views.locations(prefix):
+                yield f"last day {loc_id}", lambda loc_id=loc_id: (
+                    plot.render_figure(loc_id, start, end, base, 'plot bed sensor data'),
+                    download_coaching_sleep(loc_id, start, end + datetime.timedelta(days=1)))
+    elif view == "week":
+        for loc_id in all_loc_ids:
+            for start, end in views.last_week():
+                yield f"last week {loc_id} {start:%Y-%m-%d}", lambda loc_id=loc_id, start=start, end=end: (
+                    plot.render_figure(loc_id, start, end, base, 'plot bed sensor data'),
+                    download_coaching_sleep(loc_id, start, end))
+    elif view == "presence":
+        # Keeps the presence index of the detail view current, so its first,
+        # full scan is not left to a user's request.
+        yield "presence index", lambda: presence.refresh(base, max_age=presence.INDEX_TTL.total_seconds())
+        start, end = views.data_presence()
+        for prefix in prefixes:
+            loc_ids = views.locations(prefix)
+            yield f"data presence {prefix}", lambda loc_ids=loc_ids: fleet_presence(
+                loc_ids, plot.PRESENCE_SOURCES, start, end, base, freq=views.PRESENCE_FREQ)
+            for loc_id in loc_ids:
+                yield f"data presence {loc_id}", lambda loc_id=loc_id: plot.render_figure(
+                    loc_id, start, end, base, 'check data presence', freq=views.PRESENCE_FREQ, clip=False)
+
+
+def run(base, selected, prefixes, delay):
+    """Runs the jobs of the selected views one by one, pausing delay seconds
+    between them to leave the database to interactive users. Returns the
+    number of failed jobs."""
+    connection.reset_stats()
+    started = time.time()
+    done = failed = 0
+    for view in selected:
+        for description, job in jobs(view, base, prefixes):
+            job_started = time.time()
+            try:
+                job()
+                done += 1
+                logging.info(f"{description}: {time.time() - job_started:.1f} s")
+            except Exception as e:
+                failed += 1
+                logging.warning(f"{description} raised {e!r}")
+            time.sleep(delay)
+    stats = connection.get_stats()
+    logging.info(f"Run on {base} done in {time.time() - started:.0f} s: {done} jobs, {failed} failed, "
+                 f"{stats.get('round_trips', 0)} round trips.")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base", choices=("prod", "dev"), default="prod")
+    parser.add_argument("--views", nargs="+", choices=VIEWS, default=list(VIEWS))
+    parser.add_argument("--prefixes", nargs="+", choices=views.PREFIXES, default=list(views.PREFIXES))
+    parser.add_argument("--every", type=float, default=0,
+                        help="minutes from the start of one run to the next, 0 to run once")
+    parser.add_argument("--delay", type=float, default=1.0,
+                        help="seconds to pause between jobs")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename='./prefetch.log',
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    caching.set_warming(datetime.timedelta(minutes=args.every) + caching.LIVE_TTL)
+    while True:
+        started = time.time()
+        run(args.base, args.views, args.prefixes, args.delay)
+        if not args.every:
+            break
+        time.sleep(max(0, started + args.every * 60 - time.time()))
+
+
+if __name__ == "__main__":
+    main()
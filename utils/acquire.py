@@ -1,14 +1,51 @@
 import os
+import re
 import gc
 import time
 import json
 import datetime
 import pandas as pd
 import numpy as np
-from pymongo import MongoClient
-import diskcache as dc
+from utils.connection import get_db
+from utils import caching
+from utils import catalog
+from utils import columns
+from utils import presence
+from utils import rawbson
 import logging
-cache = dc.Cache("cache/")
+import functools
+import operator
+import threading
+from collections import namedtuple, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+cache = caching.get_cache("downloads")
+coaching_cache = caching.get_cache("coaching")
+
+# Fields the decoders actually read. Queries fetch only these.
+SENSOR_FIELDS = ("SourceId", "Data.Timestamp", "Data.Timestep", "Data.Measurements")
+ADDITIONAL_FIELDS = ("SourceId", "Data.Timestamp", "Data.Measurements")
+COACHING_FIELDS = ("Timestamp", "CoachingAction", "Completion", "Parameters")
+
+# Downloads are cached in aligned chunks of this length.
+DOWNLOAD_CHUNK = datetime.timedelta(hours=1)
+# Concurrent queries per fan_out call. The pool size of the shared
+# client (utils.connection) bounds the total load on the database.
+DOWNLOAD_WORKERS = int(os.environ.get("SAAM_DOWNLOAD_WORKERS", 8))
+# Packets held in memory at once by the streaming downloads.
+STREAM_BATCH_SIZE = int(os.environ.get("SAAM_STREAM_BATCH_SIZE", 1000))
+_MISSING = caching._MISSING
+
+
+def _projection(fields):
+    """Turns a tuple of dotted field names into a find projection.
+    None means whole documents."""
+    if fields is None:
+        return None
+    projection = {field: 1 for field in fields}
+    projection["_id"] = 0
+    return projection
 
 
 def _download(
@@ -17,8 +54,10 @@ def _download(
     start_date: datetime.datetime, 
     end_date: datetime.datetime = None,
     collection: str = "SensorDataPackages",
-    base = "prod"):
+    base = "prod",
+    fields = SENSOR_FIELDS):
     """Queries the database for given location id, source id and in given datarange. 
+    Only given fields are returned (all if fields is None).
     Returns the response form server as string."""
 
     if not end_date:
@@ -26,6 +65,9 @@ def _download(
     assert start_date < end_date, "Start_date should be less than end_date."
 
     db = _get_db(base)
+    source_id = catalog.expand_source(base, loc_id, collection, source_id, end_date.timestamp() * 1e3)
+    if source_id == {"$in": []}:
+        return []
     collection = db[collection]
 
     results = collection.find(
@@ -36,95 +78,806 @@ def _download(
             "$gt": start_date.timestamp() * 1e3,
             "$lt": end_date.timestamp() * 1e3,
                           }
-        })
+        },
+        _projection(fields))
 
     return list(results)
 
+def _download_span(
+    loc_id: str,
+    source_id: str,
+    lo_ms: int,
+    hi_ms: int,
+    collection: str = "SensorDataPackages",
+    base = "prod",
+    fields = SENSOR_FIELDS,
+    after = None):
+    """Like _download, but for the half open interval [lo_ms, hi_ms)
+    given in utc milliseconds, so that adjacent spans do not overlap."""
+    results = _span_cursor(loc_id, source_id, lo_ms, hi_ms, collection, base, fields, after=after)
+    return list(results) if results is not None else []
+
+
+def _span_cursor(loc_id, source_id, lo_ms, hi_ms, collection, base, fields, batch_size=0, raw=False, after=None):
+    """Cursor over the packets of _download_span, None if there can not be any.
+    With raw, packets come as undecoded RawBSONDocuments. With after, a
+    {SourceId: ms} dict, packets of those SourceIds are only returned from
+    their ms on, those of other SourceIds from lo_ms on."""
+    source_id = catalog.expand_source(base, loc_id, collection, source_id, hi_ms)
+    if source_id == {"$in": []}:
+        return None
+    collection = _get_db(base)[collection]
+    if raw:
+        collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    query = {
+        "LocationId": loc_id,
+        "SourceId": source_id,
+        "Data.Timestamp": {"$gte": lo_ms, "$lt": hi_ms}
+        }
+    if after:
+        query["$or"] = [{"SourceId": source, "Data.Timestamp": {"$gte": since_ms}}
+                        for source, since_ms in sorted(after.items())]
+        query["$or"].append({"SourceId": {"$nin": sorted(after)}})
+    return collection.find(query, _projection(fields), batch_size=batch_size)
+
+
+def stream_download(
+    loc_id: str,
+    source_id: str,
+    lo_ms: int,
+    hi_ms: int,
+    collection: str = "SensorDataPackages",
+    base = "prod",
+    fields = SENSOR_FIELDS,
+    batch_size = STREAM_BATCH_SIZE,
+    raw = False,
+    after = None):
+    """Yields the packets of _download_span in lists of at most batch_size,
+    as they come from the cursor, so they never all sit in memory at once.
+    With raw, packets are RawBSONDocuments, for decoders that read the bytes."""
+    results = _span_cursor(loc_id, source_id, lo_ms, hi_ms, collection, base, fields, batch_size, raw, after)
+    if results is None:
+        return
+    batch = []
+    for item in results:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _chunk_starts(start_ms, end_ms, chunk_ms):
+    """Starts of the aligned chunks covering (start_ms, end_ms)."""
+    first = int(start_ms) // chunk_ms * chunk_ms
+    return list(range(first, int(np.ceil(end_ms)), chunk_ms))
+
+
+def _runs(chunk_starts, chunk_ms):
+    """Groups sorted chunk starts into contiguous (lo_ms, hi_ms) spans."""
+    runs = []
+    for chunk_start in chunk_starts:
+        if runs and runs[-1][1] == chunk_start:
+            runs[-1][1] = chunk_start + chunk_ms
+        else:
+            runs.append([chunk_start, chunk_start + chunk_ms])
+    return [tuple(run) for run in runs]
+
+
+def _chunked(key, chunk_starts, chunk_ms, fetch, split, tier=None, delta=None):
+    """Returns the cached values for given chunks, in order.
+
+    Chunks missing from cache are fetched with as few calls to
+    fetch(lo_ms, hi_ms) as possible, one per contiguous run, and
+    split(value, run_chunk_starts, chunk_ms) cuts each result back
+    into per chunk values. Chunks are stored with the freshness policy
+    of utils.caching, so chunks still receiving data get refreshed.
+    fetch can raise _Uncacheable to return incomplete values unstored.
+    Sealed chunks go to tier instead of the disk cache, if given; tier has
+    load(chunk_start, default) and save(chunk_start, value) methods.
+
+    With delta, a (merge(old, new), high_water(value)) pair, expired chunks
+    that are not sealed yet are refreshed with fetch(lo_ms, hi_ms, after),
+    asking every SourceId only for the packets newer than the newest
+    Data.Timestamp of it high_water ({SourceId: ms}) finds in their previous
+    value, and SourceIds missing from it for the whole chunk. SourceIds
+    uploading later than others are so not skipped. Once sealed, a chunk
+    is fetched whole one last time, to catch late packets."""
+    values = dict()
+    missing = []
+    for chunk_start in chunk_starts:
+        value = _MISSING
+        if tier is not None:
+            value = tier.load(chunk_start, default=_MISSING)
+        if value is _MISSING:
+            value = caching.cached(cache, key + (chunk_start,))
+        if value is _MISSING:
+            if delta is not None and _delta_refresh(key, chunk_start, chunk_ms, fetch, split, delta, values):
+                continue
+            missing.append(chunk_start)
+        else:
+            values[chunk_start] = value
+    for lo_ms, hi_ms in _runs(missing, chunk_ms):
+        logging.info(f"Not cached! Downloading {key} for [{lo_ms}, {hi_ms}).")
+        run_starts = list(range(lo_ms, hi_ms, chunk_ms))
+        try:
+            fetched = split(fetch(lo_ms, hi_ms), run_starts, chunk_ms)
+            complete = True
+        except _Uncacheable as e:
+            fetched = e.values
+            complete = False
+        for chunk_start, value in zip(run_starts, fetched):
+            values[chunk_start] = value
+            if not complete:
+                continue
+            if tier is not None and caching.is_sealed(chunk_start + chunk_ms):
+                tier.save(chunk_start, value)
+            else:
+                caching.store(cache, key + (chunk_start,), value, chunk_start + chunk_ms)
+                if delta is not None:
+                    _store_delta_base(key, chunk_start, chunk_ms, value)
+    return [values[chunk_start] for chunk_start in chunk_starts]
+
+
+def _store_delta_base(key, chunk_start, chunk_ms, value):
+    """Keeps the value of a chunk that is not sealed yet until it is,
+    as the base of delta refreshes."""
+    if caching.is_sealed(chunk_start + chunk_ms):
+        return
+    sealed_at = (chunk_start + chunk_ms) / 1e3 + caching.SETTLE_DELAY.total_seconds()
+    cache.set(key + (chunk_start, "delta"), value,
+              expire=max(sealed_at - time.time(), 0) + caching.LIVE_TTL.total_seconds(), tag=caching.LIVE)
+
+
+def _delta_refresh(key, chunk_start, chunk_ms, fetch, split, delta, values):
+    """Refreshes a chunk that is not sealed from its delta base, see _chunked.
+    Returns False if that is not possible, and the chunk has to be fetched whole."""
+    merge, high_water = delta
+    if caching.is_sealed(chunk_start + chunk_ms):
+        return False
+    old = cache.get(key + (chunk_start, "delta"), default=_MISSING)
+    if old is _MISSING:
+        return False
+    newest = high_water(old)
+    if not newest:
+        return False
+    after = {source_id: int(np.floor(ms)) + 1 for source_id, ms in newest.items()}
+    logging.info(f"Refreshing {key} for [{chunk_start}, {chunk_start + chunk_ms}) after {after}.")
+    try:
+        new = split(fetch(chunk_start, chunk_start + chunk_ms, after), [chunk_start], chunk_ms)[0]
+        complete = True
+    except _Uncacheable as e:
+        new = e.values[0]
+        complete = False
+    value = merge(old, new)
+    values[chunk_start] = value
+    if complete:
+        caching.store(cache, key + (chunk_start,), value, chunk_start + chunk_ms)
+        _store_delta_base(key, chunk_start, chunk_ms, value)
+    return True
+
+
+class _Uncacheable(Exception):
+    """Carries per chunk values that are incomplete and must not be cached."""
+    def __init__(self, values):
+        super().__init__()
+        self.values = values
+
+
+def _split_documents(documents, chunk_starts, chunk_ms):
+    """Distributes documents into the chunks their Data.Timestamp falls in."""
+    parts = [list() for _ in chunk_starts]
+    for item in documents:
+        parts[int(item["Data"]["Timestamp"] - chunk_starts[0]) // chunk_ms].append(item)
+    return parts
+
+
+def _newest_documents(documents):
+    """{SourceId: newest Data.Timestamp} of documents."""
+    newest = dict()
+    for item in documents:
+        source_id, timestamp = item["SourceId"], item["Data"]["Timestamp"]
+        newest[source_id] = max(newest.get(source_id, timestamp), timestamp)
+    return newest
+
+
 def download(loc_id: str, 
             source_id: str,
             start_date: datetime.datetime, 
             end_date: datetime.datetime = None,
             collection: str = "SensorDataPackages",
-            base = "prod"):
-    global cache
-    key = f"{start_date}|{end_date}|{loc_id}|{source_id}|{collection}|{base}"
-    # print(key)
-    logging.info(f"Caching key: {key}")
-    try:
-        return cache[key]
-    except KeyError:
-        print("Not cached! Key: ", key, end="\r")
-        logging.info("Not cached! Downlading key: "+key)
-        cached = _download(loc_id,source_id,start_date,end_date,collection=collection,base=base)
-        cache[key] = cached
-        return cached
+            base = "prod",
+            fields = SENSOR_FIELDS,
+            chunk: datetime.timedelta = DOWNLOAD_CHUNK):
+    """Cached version of _download. The range is cached in aligned chunks
+    of given length, so overlapping and sliding windows only download the
+    chunks that are not cached yet."""
+    if not end_date:
+        end_date = datetime.datetime.utcnow()
+    assert start_date < end_date, "Start_date should be less than end_date."
+    start_ms = start_date.timestamp() * 1e3
+    end_ms = end_date.timestamp() * 1e3
+    chunk_ms = int(chunk.total_seconds() * 1e3)
+    key = ("download", base, loc_id, str(source_id), collection, fields, chunk_ms)
+
+    def fetch(lo_ms, hi_ms, after=None):
+        return _download_span(loc_id, source_id, lo_ms, hi_ms, collection=collection, base=base, fields=fields,
+                              after=after)
+
+    parts = _chunked(key, _chunk_starts(start_ms, end_ms, chunk_ms), chunk_ms, fetch, _split_documents,
+                     delta=(operator.add, _newest_documents))
+    return [item for part in parts for item in part
+            if start_ms < item["Data"]["Timestamp"] < end_ms]
+
 
 
+def fan_out(jobs, max_workers = DOWNLOAD_WORKERS):
+    """Runs (name, function) jobs concurrently on a bounded thread pool.
+    Returns results and errors, dicts keyed by job name in job order.
+    A failing job only ends up in errors, the others still return."""
+    results = dict()
+    errors = dict()
+    if not jobs:
+        return results, errors
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [(name, executor.submit(function)) for name, function in jobs]
+        for name, future in futures:
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.warning(f"Job {name} raised {e!r}")
+                errors[name] = e
+    return results, errors
+
+
+def download_jobs(
+    loc_id: str,
+    source_id: str,
+    start_date: datetime.datetime,
+    end_date: datetime.datetime = None,
+    base = "prod",
+    collections = None,
+    **kwargs):
+    """(collection, job) pairs for fan_out, downloading from each given
+    collection (by default those routed by the catalog)."""
+    if collections is None:
+        collections = catalog.collections_for(base, start_date, end_date, loc_id)
+    return [(collection, functools.partial(download, loc_id, source_id, start_date, end_date,
+                                           collection=collection, base=base, **kwargs))
+            for collection in collections]
+
+
+def download_collections(
+    loc_id: str,
+    source_id: str,
+    start_date: datetime.datetime,
+    end_date: datetime.datetime = None,
+    base = "prod",
+    collections = None,
+    max_workers = DOWNLOAD_WORKERS,
+    **kwargs):
+    """Downloads from several collections in parallel. Returns the payload,
+    concatenated in collection order, and {collection: exception} of the
+    collections that failed."""
+    results, errors = fan_out(
+        download_jobs(loc_id, source_id, start_date, end_date, base, collections, **kwargs),
+        max_workers=max_workers)
+    deduplicator = Deduplicator()
+    payload = [item for result in results.values() for item in deduplicator.filter(result)]
+    deduplicator.report(f"{loc_id} {source_id}")
+    return payload, errors
+
+
+def _packet_key(item):
+    """(SourceId, Data.Timestamp, packet length) identifying a packet across
+    collections. The length is the number of measurements, or the size in
+    bytes of the measurements of RawBSONDocuments."""
+    if isinstance(item, RawBSONDocument):
+        source_id, timestamp, timestep, measurements = rawbson.packet_header(item.raw)
+        return source_id, timestamp, measurements and measurements[1]
+    measurements = item["Data"].get("Measurements")
+    return item.get("SourceId"), item["Data"].get("Timestamp"), len(measurements) if measurements is not None else None
+
+
+class Deduplicator:
+    """Drops packets that were already seen, such as those present both in
+    a monthly archive and in the live collection. Shared by the jobs of a
+    download, so it is thread safe."""
+    def __init__(self):
+        self.seen = set()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, batch):
+        keys = [_packet_key(item) for item in batch]
+        kept = []
+        with self.lock:
+            for key, item in zip(keys, batch):
+                if key not in self.seen:
+                    self.seen.add(key)
+                    kept.append(item)
+            self.dropped += len(batch) - len(kept)
+        return kept
+
+    def report(self, what):
+        """Logs and counts the dropped packets."""
+        if self.dropped:
+            logging.info(f"Dropped {self.dropped} duplicate packets of {what}.")
+            with _duplicates_lock:
+                _duplicates["packets"] += self.dropped
+
+
+_duplicates = Counter()
+_duplicates_lock = threading.Lock()
+
+
+def get_duplicate_stats():
+    """Returns {"packets": number} of duplicate packets dropped since the last reset."""
+    with _duplicates_lock:
+        return dict(_duplicates)
+
+
+def reset_duplicate_stats():
+    with _duplicates_lock:
+        _duplicates.clear()
+
+
+AccelSeries = namedtuple("AccelSeries", ["t", "x", "y", "z", "m"])
+
+
+def decode_accel(response_list):
+    """Decodes accelerometer packets into columns, sorted by time.
+    Returns AccelSeries of int64 timestamps (utc, ms) and float32 x, y, z
+    and magnitude arrays. Missing and zero valued axes become NaN."""
+    return _assemble_accel(*_accel_columns(response_list))
+
+
+def decode_accel_raw(raw_list):
+    """decode_accel for RawBSONDocument packets. Measurements of the usual
+    layout are read straight from the BSON bytes (utils.rawbson), other
+    packets are decoded into dicts first."""
+    raws = [item.raw for item in raw_list]
+    columns, fallback = rawbson.accel_columns(raws)
+    lengths, stops, timesteps, x, y, z = columns
+    x, y, z = (axis.astype(np.float32) for axis in (x, y, z))
+    for axis in (x, y, z):
+        # As "or np.nan" does for decoded packets.
+        axis[axis == 0] = np.nan
+    if fallback:
+        decoded = _accel_columns([rawbson.decode(raws[i]) for i in fallback])
+        lengths, stops, timesteps, x, y, z = (np.concatenate(pair) for pair in zip(
+            (lengths, stops, timesteps, x, y, z), decoded))
+    return _assemble_accel(lengths, stops, timesteps, x, y, z)
+
+
+def _accel_columns(response_list):
+    """(lengths, stops, timesteps, x, y, z) of decoded packets."""
+    num_packets = len(response_list)
+    lengths = np.fromiter(
+        (len(item["Data"]["Measurements"]) for item in response_list),
+        dtype=np.int64, count=num_packets)
+    stops = np.fromiter(
+        (item["Data"]["Timestamp"] for item in response_list),
+        dtype=np.float64, count=num_packets)
+    timesteps = np.fromiter(
+        (item["Data"]["Timestep"] for item in response_list),
+        dtype=np.float64, count=num_packets)
+    total = int(lengths.sum())
+
+    def axis(name):
+        return np.fromiter(
+            (i.get(name) or np.nan for item in response_list for i in item["Data"]["Measurements"]),
+            dtype=np.float32, count=total)
+    return lengths, stops, timesteps, axis("x"), axis("y"), axis("z")
+
+
+def _accel_order(t, x, y, z):
+    """Stable sort by time. Ties within a millisecond are ordered by x, y, z
+    as before, on the values they had before zeros became NaN."""
+    return np.lexsort(tuple(np.nan_to_num(axis, nan=0.0) for axis in (z, y, x)) + (t,))
+
+
+def _assemble_accel(lengths, stops, timesteps, x, y, z):
+    """AccelSeries of the columns of _accel_columns."""
+    num_packets = len(lengths)
+    timesteps = timesteps * 1000 # ms
+    total = int(lengths.sum())
+
+    # Same spacing as np.linspace(timestamp-timestep, timestamp, num_entries) per packet.
+    starts = stops - timesteps
+    steps = (stops - starts) / np.maximum(lengths - 1, 1)
+    offsets = np.cumsum(lengths) - lengths
+    owner = np.repeat(np.arange(num_packets), lengths)
+    positions = np.arange(total) - offsets[owner]
+    t = positions * steps[owner] + starts[owner]
+    multi = lengths > 1
+    t[(offsets + lengths - 1)[multi]] = stops[multi]
+    t = np.floor(t).astype(np.int64)
+
+    order = _accel_order(t, x, y, z)
+    t, x, y, z = t[order], x[order], y[order], z[order]
+    m = np.sqrt(x**2 + y**2 + z**2)
+    return AccelSeries(t, x, y, z, m)
+
 
 def magnitude_response_to_data(response_list):
-    """Aggregates the database response into time(utc, ms), x, y, z components."""
-    import numpy as np
-    timestamps = []
-    xs = []
-    ys = []
-    zs = []
-    for item in response_list:
-        timestamp = item["Data"]["Timestamp"]
-        timestep = item["Data"]["Timestep"] * 1000 # ms
-        num_entries = len(item["Data"]["Measurements"])
-        current_timestamps = np.linspace(timestamp-timestep, timestamp, num_entries, dtype=int)
-        for i in item["Data"]["Measurements"]:
-            xs.append(i.get("x", np.nan))
-            ys.append(i.get("y", np.nan))
-            zs.append(i.get("z", np.nan))
-        for t in current_timestamps:
-            timestamps.append(t)
-    # Let's sort the lists together:
-    if timestamps:
-        timestamps, xs, ys, zs = (list(t) for t in zip(*sorted(zip(timestamps, xs, ys, zs))))
-    def transform_to_magnitudes(t,x,y,z):
-        import numpy as np
-        x = np.array([i if i else np.nan for i in x])
-        y = np.array([i if i else np.nan for i in y])
-        z = np.array([i if i else np.nan for i in z])
-        try:
-            return t, (x**2 + y**2 + z**2)**0.5
-        except Exception as e:
-            breakpoint()
+    """Aggregates the database response into time(utc, ms) and magnitude."""
+    series = decode_accel(response_list)
+    return series.t, series.m
+
+SourceBuffer = namedtuple("SourceBuffer", ["packets", "timestamps", "measurements"])
+
+
+def group_by_source(payload):
+    """Partitions packets by SourceId in a single pass. Returns
+    {SourceId: SourceBuffer}, in order of first appearance, each with the
+    packets and their Data.Timestamp and Data.Measurements columns."""
+    groups = dict()
+    for item in payload:
+        group = groups.get(item["SourceId"])
+        if group is None:
+            group = groups[item["SourceId"]] = SourceBuffer([], [], [])
+        group.packets.append(item)
+        group.timestamps.append(item["Data"]["Timestamp"])
+        group.measurements.append(item["Data"]["Measurements"])
+    return groups
+
+
+PEAK_KINDS = ("L", "S")
+SLEEP_STATES = ("out_of_bed", "in_bed", "sleeping")
+_PEAK_CODES = {kind: code for code, kind in enumerate(PEAK_KINDS)}
+_STATE_CODES = {state: code for code, state in enumerate(SLEEP_STATES)}
+
+
+def _flatten_measurements(payload):
+    """All innermost measurement entries of feature packets, in one list."""
+    return [inner for item in payload if item["Data"]["Measurements"] != [[]]
+            for middle in item["Data"]["Measurements"] for inner in middle]
+
+
+def decode_peaks(payload):
+    """Returns peak times (s) and int8 codes indexing PEAK_KINDS.
+    Peaks of other kinds are dropped."""
+    entries = _flatten_measurements(payload)
+    times = np.fromiter((inner[0] for inner in entries), dtype=np.float64, count=len(entries))
+    kinds = np.fromiter((_PEAK_CODES.get(inner[1], -1) for inner in entries), dtype=np.int8, count=len(entries))
+    known = kinds >= 0
+    return times[known], kinds[known]
+
+
+def decode_states(payload):
+    """Returns interval starts and ends (s) and int8 codes indexing
+    SLEEP_STATES. Intervals of other states are dropped."""
+    entries = _flatten_measurements(payload)
+    starts = np.fromiter((inner[0] for inner in entries), dtype=np.float64, count=len(entries))
+    ends = np.fromiter((inner[1] for inner in entries), dtype=np.float64, count=len(entries))
+    codes = np.fromiter((_STATE_CODES.get(inner[-1], -1) for inner in entries), dtype=np.int8, count=len(entries))
+    known = codes >= 0
+    return starts[known], ends[known], codes[known]
 
-    return transform_to_magnitudes(timestamps, xs, ys, zs)
 
 def peak_handler(payload):
     """Helper function for peaks. Payload is output from download function"""
     assert payload != [], "No data to process."
-    Ls = []
-    Ss = []
-    measurements = [item["Data"]["Measurements"] for item in payload if item["Data"]["Measurements"] != [[]]]
-    for outer in measurements:
-        for middle in outer:
-            for inner in middle:
-                if inner[1] == "L":
-                    Ls.append(inner[0])
-                if inner[1] == "S":
-                    Ss.append(inner[0])
-    return Ls, Ss
+    times, kinds = decode_peaks(payload)
+    return [times[kinds == code].tolist() for code in range(len(PEAK_KINDS))]
 def state_handler(payload):
     """Helper function for peaks. Payload is output from download function"""
     assert payload != [], "No data to process."
-    outs = []
-    ins  = []
-    sleeps = []
-    measurements = [item["Data"]["Measurements"] for item in payload if item["Data"]["Measurements"] != [[]]]
-    for outer in measurements:
-        for middle in outer:
-            for inner in middle:
-                if inner[-1] == "out_of_bed":
-                    outs.append((inner[0], inner[1]))
-                if inner[-1] == "in_bed":
-                    ins.append((inner[0], inner[1]))
-                if inner[-1] == "sleeping":
-                    sleeps.append((inner[0], inner[1]))
-    return outs, ins, sleeps
+    starts, ends, codes = decode_states(payload)
+    return [list(zip(starts[codes == code].tolist(), ends[codes == code].tolist()))
+            for code in range(len(SLEEP_STATES))]
+
+
+class Magnitudes(dict):
+    """{SourceId: AccelSeries}, remembering the newest Data.Timestamp of
+    the packets decoded into it per SourceId in stamps."""
+    def __init__(self, series=(), stamps=None):
+        super().__init__(series)
+        self.stamps = dict(stamps or {})
+
+
+class MagnitudeDecoder:
+    """Incrementally decodes accelerometer packets with decode_accel.
+    Result is Magnitudes."""
+    def __init__(self):
+        self.parts = defaultdict(list)
+        self.stamps = dict()
+
+    def feed(self, batch):
+        groups = defaultdict(list)
+        raw = bool(batch) and isinstance(batch[0], RawBSONDocument)
+        for item in batch:
+            if raw:
+                source_id, timestamp = rawbson.packet_header(item.raw)[:2]
+            else:
+                source_id, timestamp = item["SourceId"], item["Data"]["Timestamp"]
+            groups[source_id].append(item)
+            if timestamp is not None:
+                self.stamps[source_id] = max(self.stamps.get(source_id, timestamp), timestamp)
+        for source_id, packets in groups.items():
+            self.parts[source_id].append(decode_accel_raw(packets) if raw else decode_accel(packets))
+
+    def result(self):
+        return Magnitudes({source_id: concat_accel(parts) for source_id, parts in sorted(self.parts.items())},
+                          self.stamps)
+
+    @staticmethod
+    def merge(results):
+        """Merges results of several decoders into one."""
+        parts = defaultdict(list)
+        stamps = dict()
+        for result in results:
+            for source_id, series in result.items():
+                parts[source_id].append(series)
+            for source_id, timestamp in getattr(result, "stamps", {}).items():
+                stamps[source_id] = max(stamps.get(source_id, timestamp), timestamp)
+        return Magnitudes({source_id: concat_accel(series) for source_id, series in sorted(parts.items())}, stamps)
+
+    @staticmethod
+    def newest(result):
+        """Newest Data.Timestamp decoded into a result, None if not known."""
+        return max(MagnitudeDecoder.newest_by_source(result).values(), default=None)
+
+    @staticmethod
+    def newest_by_source(result):
+        """{SourceId: newest Data.Timestamp} decoded into a result, like
+        _newest_documents. Not the newest sample time, as the only sample
+        of a packet is at Data.Timestamp - Data.Timestep. Empty for results
+        stored before they kept it, so those are fetched whole."""
+        return dict(getattr(result, "stamps", {}))
+
+    @staticmethod
+    def trim(result, start_ms, end_ms):
+        """Keeps the samples strictly between start_ms and end_ms."""
+        trimmed = dict()
+        for source_id, series in result.items():
+            keep = (series.t > start_ms) & (series.t < end_ms)
+            if keep.any():
+                trimmed[source_id] = AccelSeries(*(column[keep] for column in series))
+        return trimmed
+
+
+def concat_accel(parts):
+    """Concatenates AccelSeries and sorts them as decode_accel does."""
+    if len(parts) == 1:
+        return parts[0]
+    t, x, y, z, m = (np.concatenate(column) for column in zip(*parts))
+    if np.all(t[1:] > t[:-1]):
+        return AccelSeries(t, x, y, z, m)
+    order = _accel_order(t, x, y, z)
+    return AccelSeries(t[order], x[order], y[order], z[order], m[order])
+
+
+class PeakDecoder:
+    """Incrementally decodes peak packets with decode_peaks.
+    Result is (times, kinds) as decode_peaks returns them."""
+    version = 2
+
+    def __init__(self):
+        self.parts = []
+
+    def feed(self, batch):
+        self.parts.append(decode_peaks(batch))
+
+    def result(self):
+        return PeakDecoder.merge(self.parts)
+
+    @staticmethod
+    def merge(results):
+        if not results:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int8)
+        return tuple(np.concatenate(column) for column in zip(*results))
+
+    @staticmethod
+    def trim(result, start_ms, end_ms):
+        """Keeps the peaks strictly between start_ms and end_ms."""
+        times, kinds = result
+        keep = (times * 1e3 > start_ms) & (times * 1e3 < end_ms)
+        return times[keep], kinds[keep]
+
+
+class StateDecoder:
+    """Incrementally decodes sleep state packets with decode_states.
+    Result is (starts, ends, codes) as decode_states returns them."""
+    version = 2
+
+    def __init__(self):
+        self.parts = []
+
+    def feed(self, batch):
+        self.parts.append(decode_states(batch))
+
+    def result(self):
+        return StateDecoder.merge(self.parts)
+
+    @staticmethod
+    def merge(results):
+        if not results:
+            return np.empty(0), np.empty(0), np.empty(0, dtype=np.int8)
+        return tuple(np.concatenate(column) for column in zip(*results))
+
+    @staticmethod
+    def trim(result, start_ms, end_ms):
+        """Keeps the intervals overlapping (start_ms, end_ms)."""
+        starts, ends, codes = result
+        keep = (ends * 1e3 > start_ms) & (starts * 1e3 < end_ms)
+        return starts[keep], ends[keep], codes[keep]
+
+
+class CookingDecoder:
+    """Incrementally decodes power meter packets into
+    {feature: (timestamps in ms, values)} for the cooking features."""
+    features = ["oven", "energy", "microwave", "stove", "water_kettle"]
+
+    def __init__(self):
+        self.series = {feature: ([], []) for feature in self.features}
+
+    def feed(self, batch):
+        for source_id, group in group_by_source(batch).items():
+            values = [i[0].get("dP") if isinstance(i[0], dict) else i[0] for i in group.measurements]
+            for feature in self.features:
+                if feature in source_id:
+                    self.series[feature][0].extend(group.timestamps)
+                    self.series[feature][1].extend(values)
+
+    def result(self):
+        return self.series
+
+    @staticmethod
+    def merge(results):
+        merged = {feature: ([], []) for feature in CookingDecoder.features}
+        for result in results:
+            for feature, (timestamps, values) in result.items():
+                merged[feature][0].extend(timestamps)
+                merged[feature][1].extend(values)
+        return merged
+
+    @staticmethod
+    def trim(result, start_ms, end_ms):
+        """Keeps the packets from start_ms up to end_ms, as _download_span does."""
+        trimmed = dict()
+        for feature, (timestamps, values) in result.items():
+            keep = [i for i, timestamp in enumerate(timestamps) if start_ms <= timestamp < end_ms]
+            trimmed[feature] = ([timestamps[i] for i in keep], [values[i] for i in keep])
+        return trimmed
+
+
+def _stream_into(decoder, loc_id, source_id, lo_ms, hi_ms, collections, base, fields, batch_size, raw=False,
+                 deduplicator=None, after=None):
+    """Feeds the packets of collections into decoder, dropping
+    those deduplicator has seen before, if given."""
+    for collection in collections:
+        for batch in stream_download(loc_id, source_id, lo_ms, hi_ms, collection, base, fields, batch_size, raw,
+                                     after):
+            if deduplicator is not None:
+                batch = deduplicator.filter(batch)
+            decoder.feed(batch)
+    return decoder
+
+
+def download_decoded(
+    decoder_class,
+    loc_id: str,
+    source_id: str,
+    start_date: datetime.datetime,
+    end_date: datetime.datetime = None,
+    base = "prod",
+    collections = None,
+    fields = ADDITIONAL_FIELDS,
+    batch_size = STREAM_BATCH_SIZE,
+    chunk: datetime.timedelta = DOWNLOAD_CHUNK):
+    """Streams the packets of given collections (by default those routed by
+    the catalog) through decoder_class instances and returns the result.
+    The decoded results, not the packets, are cached in aligned chunks like
+    download, so sliding windows only decode the chunks they add.
+    decoder_class has merge(results) and trim(result, start_ms, end_ms)
+    static methods, like MagnitudeDecoder."""
+    if not end_date:
+        end_date = datetime.datetime.utcnow()
+    assert start_date < end_date, "Start_date should be less than end_date."
+    if collections is None:
+        collections = catalog.collections_for(base, start_date, end_date, loc_id)
+    start_ms = start_date.timestamp() * 1e3
+    end_ms = end_date.timestamp() * 1e3
+    chunk_ms = int(chunk.total_seconds() * 1e3)
+    # Decoders bump their version when the format of their result changes.
+    name = f"{decoder_class.__name__}-{getattr(decoder_class, 'version', 1)}"
+    key = ("decoded", name, base, loc_id, str(source_id), tuple(collections), fields, chunk_ms)
+
+    def fetch(lo_ms, hi_ms):
+        deduplicator = Deduplicator()
+        router = _stream_into(_ChunkRouter(decoder_class, list(range(lo_ms, hi_ms, chunk_ms)), chunk_ms),
+                              loc_id, source_id, lo_ms, hi_ms, collections, base, fields, batch_size,
+                              deduplicator=deduplicator)
+        deduplicator.report(f"{loc_id} {source_id}")
+        return router.result()
+
+    parts = _chunked(key, _chunk_starts(start_ms, end_ms, chunk_ms), chunk_ms, fetch, lambda values, *_: values)
+    return decoder_class.trim(decoder_class.merge(parts), start_ms, end_ms)
+
+
+class _ChunkRouter:
+    """Feeds packets into one decoder per chunk, by Data.Timestamp."""
+    def __init__(self, decoder_class, chunk_starts, chunk_ms):
+        self.decoders = [decoder_class() for _ in chunk_starts]
+        self.first = chunk_starts[0]
+        self.chunk_ms = chunk_ms
+
+    def feed(self, batch):
+        parts = defaultdict(list)
+        for item in batch:
+            if isinstance(item, RawBSONDocument):
+                timestamp = rawbson.packet_header(item.raw)[1]
+            else:
+                timestamp = item["Data"]["Timestamp"]
+            parts[int(timestamp - self.first) // self.chunk_ms].append(item)
+        for i, part in parts.items():
+            self.decoders[i].feed(part)
+
+    def result(self):
+        return [decoder.result() for decoder in self.decoders]
+
+
+def download_accel(
+    loc_id: str,
+    source_id: str,
+    start_date: datetime.datetime,
+    end_date: datetime.datetime = None,
+    base = "prod",
+    collections = None,
+    chunk: datetime.timedelta = DOWNLOAD_CHUNK,
+    batch_size = STREAM_BATCH_SIZE):
+    """Accelerometer magnitudes between start_date and end_date as
+    {SourceId: AccelSeries}, and {collection: exception} of failed collections.
+
+    Packets are streamed from all collections in parallel, as raw BSON,
+    by default from those the catalog routes each fetched chunk to,
+    and decoded batch by batch, so memory is bounded by batch_size rather
+    than the range.
+    The decoded series are cached in aligned chunks, like download, closed
+    chunks as memory mapped columns (utils.columns)."""
+    if not end_date:
+        end_date = datetime.datetime.utcnow()
+    assert start_date < end_date, "Start_date should be less than end_date."
+    start_ms = start_date.timestamp() * 1e3
+    end_ms = end_date.timestamp() * 1e3
+    chunk_ms = int(chunk.total_seconds() * 1e3)
+    routing = tuple(collections) if collections is not None else "catalog"
+    key = ("accel", base, loc_id, str(source_id), routing, chunk_ms)
+    errors = dict()
+
+    def fetch(lo_ms, hi_ms, after=None):
+        run_starts = list(range(lo_ms, hi_ms, chunk_ms))
+        run_collections = collections
+        if run_collections is None:
+            # Routed by the chunks, not the window, so that a chunk straddling
+            # the start of a window is complete whichever window fetched it.
+            run_collections = catalog.collections_for(
+                base, datetime.datetime.fromtimestamp(lo_ms / 1e3), datetime.datetime.fromtimestamp(hi_ms / 1e3),
+                loc_id)
+        # Collections overlap, the first to deliver a packet gets it decoded.
+        deduplicator = Deduplicator()
+        jobs = [(collection, functools.partial(
+                    _stream_into, _ChunkRouter(MagnitudeDecoder, run_starts, chunk_ms),
+                    loc_id, source_id, lo_ms, hi_ms, [collection], base, SENSOR_FIELDS, batch_size, raw=True,
+                    deduplicator=deduplicator, after=after))
+                for collection in run_collections]
+        results, failed = fan_out(jobs)
+        deduplicator.report(f"{loc_id} {source_id}")
+        per_collection = [router.result() for router in results.values()]
+        values = [MagnitudeDecoder.merge(parts) for parts in zip(*per_collection)] or [Magnitudes() for _ in run_starts]
+        if failed:
+            errors.update(failed)
+            raise _Uncacheable(values)
+        return values
+
+    tier = columns.ColumnStore(base, loc_id, source_id, chunk_ms, routing, size_limit=caching.columns_limit())
+    parts = _chunked(key, _chunk_starts(start_ms, end_ms, chunk_ms), chunk_ms, fetch, lambda values, *_: values,
+                     tier=tier,
+                     delta=(lambda old, new: MagnitudeDecoder.merge([old, new]), MagnitudeDecoder.newest_by_source))
+    return MagnitudeDecoder.trim(MagnitudeDecoder.merge(parts), start_ms, end_ms), errors
 
 
 def check_source_presence(
@@ -133,14 +886,21 @@ def check_source_presence(
     start_date, #datetime.datetime object
     end_date, 
     base = "prod",
-    freq = "1h"):
+    freq = "1h",
+    mode = "index"):
     """Creates a pandas.date_range, for each period in it
     it queryies given base and all sensor data collections 
     for {"$regex": source_id},
-    returns timerange, is_data (= list of bool)."""
+    returns timerange, is_data (= list of bool).
+
+    mode "index" answers from the minute bitmaps of utils.presence (falling
+    back to "aggregate" for periods that are not whole minutes), mode
+    "aggregate" buckets the timestamps on the server, with a single
+    aggregation per collection, mode "loop" queries every period separately."""
 
 
     assert start_date < end_date, "Start_date should be less than end_gate."
+    assert mode in ("index", "aggregate", "loop"), f"Unknown mode {mode}."
         
     db = _get_db(base)
 
@@ -150,41 +910,163 @@ def check_source_presence(
                     freq  = freq)
     
     is_data = np.full(len(timerange), False, dtype=bool)
+    if len(timerange) < 2:
+        return timerange, is_data[:-1]
 
-    for collection_name in db.list_collection_names():
-        if "SensorDataPackages" not in collection_name:
-            continue
-        collection = db[collection_name]
-        has_any = collection.find_one({
-                    "LocationId": loc_id,
-                    "SourceId": {"$regex": source_id},
-                    "Data.Timestamp": {"$gt": start_date.timestamp()*1000,
-                                       "$lt": end_date.timestamp()*1000
-                                      }})
-        if has_any == None:
-            # print(f"Collection {collection_name} has no data")
-            continue
-       #  print(f"Checking collection {collection_name} for feature {source_id} for {loc_id}.")
-       
-        def _check(loc_id, source_id, s, e, collection_name, base):
-            collection = db[collection_name]
-            res = collection.find_one({
-            "LocationId": loc_id,
-            "SourceId": {"$regex": source_id},
-            "Data.Timestamp": {"$gt": s.timestamp()*1000,
-                               "$lt": e.timestamp()*1000
-                              }})
+    if mode == "index":
+        indexed = presence.lookup(loc_id, source_id, timerange, base=base)
+        if indexed is not None:
+            return timerange, indexed
+        mode = "aggregate"
 
-            if res:
-                return True
-            else:
-                return False
-        for i, s, e in zip([i for i in range(len(timerange)-1)], timerange[0:-1], timerange[1:]):
-            if _check(loc_id, source_id, s, e, collection_name, base):
-                is_data[i] = is_data[i] or True
+    for collection_name in catalog.collections_for(base, start_date, end_date, loc_id):
+        if mode == "aggregate":
+            _presence_aggregate(db[collection_name], base, loc_id, source_id, timerange, is_data)
+        else:
+            _presence_loop(db[collection_name], loc_id, source_id, start_date, end_date, timerange, is_data)
     gc.collect()
     return timerange, is_data[:-1]
 
+
+def _presence_aggregate(collection, base, loc_id, source_id, timerange, is_data):
+    """Marks the periods of timerange with data in is_data, grouping
+    Data.Timestamp into periods on the server. As in _presence_loop,
+    packets exactly on a period boundary do not count."""
+    origin_ms = int(round(timerange[0].timestamp() * 1000))
+    freq_ms = int(round((timerange[1] - timerange[0]).total_seconds() * 1000))
+    source_filter = catalog.expand_source(base, loc_id, collection.name, {"$regex": source_id},
+                                          timerange[-1].timestamp()*1000)
+    buckets = collection.aggregate([
+        {"$match": {
+            "LocationId": loc_id,
+            "SourceId": source_filter,
+            "Data.Timestamp": {"$gt": origin_ms,
+                               "$lt": timerange[-1].timestamp()*1000
+                              }}},
+        {"$project": {"_id": 0, "offset": {"$subtract": ["$Data.Timestamp", origin_ms]}}},
+        {"$group": {"_id": _bucket_expression(freq_ms)}},
+        ])
+    for bucket in buckets:
+        if bucket["_id"] is None:
+            continue
+        i = int(bucket["_id"])
+        if 0 <= i < len(is_data) - 1:
+            is_data[i] = True
+
+
+def _presence_loop(collection, loc_id, source_id, start_date, end_date, timerange, is_data):
+    """Marks the periods of timerange with data in is_data,
+    with one probe plus one query per period."""
+    has_any = collection.find_one({
+                "LocationId": loc_id,
+                "SourceId": {"$regex": source_id},
+                "Data.Timestamp": {"$gt": start_date.timestamp()*1000,
+                                   "$lt": end_date.timestamp()*1000
+                                  }},
+                {"_id": 1})
+    if has_any == None:
+        return
+
+    def _check(s, e):
+        res = collection.find_one({
+        "LocationId": loc_id,
+        "SourceId": {"$regex": source_id},
+        "Data.Timestamp": {"$gt": s.timestamp()*1000,
+                           "$lt": e.timestamp()*1000
+                          }},
+        {"_id": 1})
+
+        if res:
+            return True
+        else:
+            return False
+    for i, s, e in zip([i for i in range(len(timerange)-1)], timerange[0:-1], timerange[1:]):
+        if _check(s, e):
+            is_data[i] = True
+
+def _bucket_expression(freq_ms):
+    """Aggregation expression numbering the period of "$offset" (ms since
+    the start of the first period), None for offsets on a period boundary."""
+    return {"$cond": [
+        {"$eq": [{"$mod": ["$offset", freq_ms]}, 0]},
+        None,
+        {"$floor": {"$divide": ["$offset", freq_ms]}}]}
+
+
+FleetPresence = namedtuple("FleetPresence", ["timerange", "loc_ids", "source_ids", "is_data"])
+
+
+@caching.fresh_memoize(cache)
+def fleet_presence(
+    loc_ids,
+    source_ids,
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+    base = "prod",
+    freq = "1h"):
+    """check_source_presence for every location of loc_ids and every
+    pattern of source_ids at once, with one aggregation per collection
+    grouping by LocationId, SourceId and period.
+
+    Returns FleetPresence, where is_data is a boolean array of shape
+    (len(loc_ids), len(source_ids), len(timerange) - 1)."""
+    assert start_date < end_date, "Start_date should be less than end_gate."
+    loc_ids, source_ids = list(loc_ids), list(source_ids)
+    timerange = pd.date_range(start=start_date, end=end_date, freq=freq)
+    is_data = np.zeros((len(loc_ids), len(source_ids), max(len(timerange) - 1, 0)), dtype=bool)
+    if len(timerange) < 2:
+        return FleetPresence(timerange, loc_ids, source_ids, is_data)
+    origin_ms = int(round(timerange[0].timestamp() * 1000))
+    freq_ms = int(round((timerange[1] - timerange[0]).total_seconds() * 1000))
+    end_ms = timerange[-1].timestamp() * 1000
+    patterns = [re.compile(source_id) for source_id in source_ids]
+    locations = {loc_id: i for i, loc_id in enumerate(loc_ids)}
+    matches = dict()
+
+    db = _get_db(base)
+    for collection_name in catalog.collections_for(base, start_date, end_date):
+        # Index friendly $in of the known SourceIds, unless the catalog
+        # can not vouch for all of them.
+        known = set()
+        for loc_id in loc_ids:
+            for source_id in source_ids:
+                expanded = catalog.expand_source(base, loc_id, collection_name, {"$regex": source_id}, end_ms)
+                if "$in" not in expanded:
+                    known = None
+                    break
+                known.update(expanded["$in"])
+            if known is None:
+                break
+        if known is None:
+            source_filter = {"$regex": "|".join(f"(?:{source_id})" for source_id in source_ids)}
+        elif known:
+            source_filter = {"$in": sorted(known)}
+        else:
+            continue
+        buckets = db[collection_name].aggregate([
+            {"$match": {
+                "LocationId": {"$in": loc_ids},
+                "SourceId": source_filter,
+                "Data.Timestamp": {"$gt": origin_ms, "$lt": end_ms}}},
+            {"$project": {"_id": 0, "loc": "$LocationId", "src": "$SourceId",
+                          "offset": {"$subtract": ["$Data.Timestamp", origin_ms]}}},
+            {"$group": {"_id": {"loc": "$loc", "src": "$src", "bucket": _bucket_expression(freq_ms)}}},
+            ], allowDiskUse=True)
+        for bucket in buckets:
+            key = bucket["_id"]
+            if key.get("bucket") is None or key.get("loc") not in locations:
+                continue
+            i = int(key["bucket"])
+            if not 0 <= i < is_data.shape[2]:
+                continue
+            src = key.get("src")
+            if src not in matches:
+                matches[src] = [j for j, pattern in enumerate(patterns)
+                                if isinstance(src, str) and pattern.search(src)]
+            is_data[locations[key["loc"]], matches[src], i] = True
+    return FleetPresence(timerange, loc_ids, source_ids, is_data)
+
+
 # def check_source_presence_2(
 #     loc_id: str, 
 #     source_id: str,
@@ -262,7 +1144,7 @@ def download_coaching_sleep(
     """Queries the database for given location id, source id and in given datarange. 
     Returns the response form server as string."""
 
-    return _download_coaching(loc_id, start_date, end_date, collection=collection, base=base, pipeline_name="sleep_quality")
+    return _download_coaching(loc_id, start_date, end_date, collection=collection, base=base, pipeline_name="sleep_quality", fields=COACHING_FIELDS)
 
 def download_coaching_cooking(
     loc_id: str, 
@@ -272,12 +1154,13 @@ def download_coaching_cooking(
     base = "prod"):
     """Queries the database for given location id, source id and in given datarange. 
     Returns the response form server as string."""
-    return _download_coaching(loc_id, start_date, end_date, collection=collection, base=base, pipeline_name="activity_cooking")
+    return _download_coaching(loc_id, start_date, end_date, collection=collection, base=base, pipeline_name="activity_cooking", fields=COACHING_FIELDS)
 def download_coaching_walking(
     loc_id: str, 
     start_date: datetime.datetime, 
     end_date: datetime.datetime = None,
-    base = "prod"):
+    base = "prod",
+    fields = ADDITIONAL_FIELDS):
     """Queries the database for given location id, source id and in given datarange. 
     Returns the response form server as string."""
     if not end_date:
@@ -290,17 +1173,19 @@ def download_coaching_walking(
     'LocationId': loc_id,
     "Data.Timestamp": {"$gt": start_date.timestamp() * 1e3, 
                         "$lt": end_date.timestamp() * 1e3},
-                        })
+                        },
+    _projection(fields))
     return list(rez)
 
-@cache.memoize()
+@caching.fresh_memoize(coaching_cache)
 def _download_coaching(
     loc_id: str, 
     start_date: datetime.datetime, 
     end_date: datetime.datetime = None,
     collection: str = "CoachingActionEntries",
     base = "prod",
-    pipeline_name = "sleep_quality"):
+    pipeline_name = "sleep_quality",
+    fields = None):
     """Queries the database for given location id, source id and in given datarange. 
     Returns the response form server as string."""
 
@@ -317,7 +1202,8 @@ def _download_coaching(
     "Timestamp": {"$gt": start_date.timestamp(),
                        "$lt": end_date.timestamp()
                       }
-                            })
+                            },
+    _projection(fields))
 
     return list(results)
 
@@ -329,7 +1215,8 @@ def download_additional_coaching(
         end_date: datetime.datetime = None,
         collection: str = "CoachingAdditionalDataSources",
         base = "prod",
-        regex = "sleep"):
+        regex = "sleep",
+        fields = ADDITIONAL_FIELDS):
         """Queries the database for given location id, source id and in given datarange. 
         Returns the response form server as string."""
 
@@ -346,62 +1233,56 @@ def download_additional_coaching(
         "Data.Timestamp": {"$gt": start_date.timestamp() * 1e3,
                            "$lt": end_date.timestamp() * 1e3
                           }
-                                })
+                                },
+        _projection(fields))
 
         return list(results)
 
 def _get_db(base="prod"):
-    from secrets import db_url
-    client = MongoClient(db_url)
-    db = client["saam"]
-    return db
+    return get_db(base)
 
-def download_cooking_data_original(loc_id, start, end, base,):
+def download_cooking_data_original(loc_id, start, end, base, with_errors=False):
     """Downloads cooking sensor data in a dumb way, but
     runs 75% faster compared to the 'smart' solution.
 
     Returns dict with keys [oven, energy, microwave, stove] and
-    values [rezult list from base across all collections]."""
-    db = _get_db(base=base)
-
-    res_dict = dict()
+    values [rezult list from base across all collections].
+    With with_errors also returns {(feature, collection): exception}."""
     target_features = ["oven", "energy", "microwave", "stove"]
+    jobs = []
     for target in target_features:
-        results = list()
-        for collection in db.collection_names():
-            if "SensorData" not in collection:
-                continue
-            current_results = download(loc_id, {"$regex": target+"$"}, start, end, base=base, collection=collection)
-            if current_results == []:
-                continue
-            results.extend(current_results)
-        res_dict[target] = results
+        for collection, job in download_jobs(loc_id, {"$regex": target+"$"}, start, end, base=base, fields=ADDITIONAL_FIELDS):
+            jobs.append(((target, collection), job))
+    results, errors = fan_out(jobs)
+    res_dict = {target: [] for target in target_features}
+    deduplicator = Deduplicator()
+    for (target, collection), current_results in results.items():
+        res_dict[target].extend(deduplicator.filter(current_results))
+    deduplicator.report(f"{loc_id} cooking")
+    if with_errors:
+        return res_dict, errors
     return res_dict
 
-def download_cooking_data(loc_id, start, end, base,):
+def download_cooking_data(loc_id, start, end, base, with_errors=False):
     """Downloads cooking sensor data in a dumb way, but
     runs 75% faster compared to the 'smart' solution.
 
     Returns dict with keys [oven, energy, microwave, stove] and
-    values [rezult list from base across all collections]."""
-    db = _get_db(base=base)
-
+    values [rezult list from base across all collections].
+    With with_errors also returns {collection: exception}."""
     res_dict = dict()
     
     
-    results = list()
-    for collection in db.collection_names():
-        if "SensorData" not in collection:
-            continue
-        current_results = download(loc_id, {"$regex": "_power_"}, start, end, base=base, collection=collection)
-        if current_results == []:
-            continue
-        results.extend(current_results)
+    results, errors = download_collections(loc_id, {"$regex": "_power_"}, start, end, base=base, fields=ADDITIONAL_FIELDS)
+    groups = group_by_source(results)
     target_features = ["oven", "energy", "microwave", "stove", "water_kettle"]
     #target_features = list(set(item["SourceId"] for item in results))
     #target_features = ["sens_power_f1_event_water_kettle"]
     for target in target_features:
-        res_dict[target] = [item for item in results if target in item["SourceId"]]
+        res_dict[target] = [item for source_id, group in groups.items() if target in source_id
+                            for item in group.packets]
+    if with_errors:
+        return res_dict, errors
     return res_dict
 
 def process_data(loc_id, start, end, base="prod"):
@@ -427,19 +1308,15 @@ def process_data(loc_id, start, end, base="prod"):
             "values": measurements
         }
     
-    additional_keys = [i["SourceId"] for i in additional_coachings]
-    for key in additional_keys:
+    for key, group in group_by_source(additional_coachings).items():
         if "sleep_state" in key:
             continue
         if key == 'app_sleep_diary_evening':
             continue
-        subset = [i for i in additional_coachings if i["SourceId"] == key]
-        timestamps = [i["Data"]["Timestamp"] for i in subset]
-        measurements = [i["Data"]["Measurements"][0] for i in subset]
         
         datadict[key] = {
-            "timestamps_ms": timestamps,
-            "values": measurements
+            "timestamps_ms": group.timestamps,
+            "values": [i[0] for i in group.measurements]
         }
     
     
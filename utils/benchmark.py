@@ -0,0 +1,36 @@
+import time
+import datetime
+import numpy as np
+from utils import acquire as ac
+from utils import connection
+
+
+def _timed(function, *args, **kwargs):
+    """Returns (result, seconds, database round trips) of a call."""
+    before = connection.get_stats().get("round_trips", 0)
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    return result, seconds, connection.get_stats().get("round_trips", 0) - before
+
+
+def compare_presence_modes(
+    loc_id: str,
+    source_id: str,
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+    base = "prod",
+    freq = "15min"):
+    """Runs check_source_presence in every mode and prints the wall time
+    and round trips of each. Returns True if all modes agree.
+
+    The first run of the index mode includes building the index."""
+    outputs = dict()
+    for mode in ("loop", "aggregate", "index"):
+        (timerange, is_data), seconds, round_trips = _timed(
+            ac.check_source_presence, loc_id, source_id, start_date, end_date,
+            base=base, freq=freq, mode=mode)
+        outputs[mode] = is_data
+        print(f"{mode:>9}: {seconds:7.2f} s, {round_trips:5d} round trips, "
+              f"{is_data.sum()}/{len(is_data)} periods with data")
+    return all(np.array_equal(outputs["loop"], is_data) for is_data in outputs.values())
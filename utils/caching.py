@@ -0,0 +1,275 @@
+import os
+import time
+import inspect
+import datetime
+import functools
+import threading
+import logging
+import diskcache as dc
+from utils import columns
+from utils import compression
+
+# Packets keep arriving for a while after they were recorded, so a period
+# is only considered closed once it ended at least SETTLE_DELAY ago.
+SETTLE_DELAY = datetime.timedelta(hours=1)
+# Entries covering periods that are not closed yet are refreshed this often.
+LIVE_TTL = datetime.timedelta(minutes=5)
+
+SEALED = "sealed"
+LIVE = "live"
+_live_ttl = LIVE_TTL
+_warming = ()
+_MISSING = object()
+
+CACHE_DIR = "cache"
+GB = 1024 ** 3
+# (size limit in bytes, diskcache eviction policy) per namespace. Expired
+# live entries are culled first, then entries by policy. The catalog and
+# the presence index are small and slow to rebuild, so they are never evicted.
+# The decoded columns of utils.columns get what the downloads cache leaves of
+# its limit, see columns_limit().
+NAMESPACES = {
+    "downloads": (int(float(os.environ.get("SAAM_CACHE_DOWNLOADS_GB", 20)) * GB), "least-recently-used"),
+    "coaching": (int(float(os.environ.get("SAAM_CACHE_COACHING_GB", 1)) * GB), "least-recently-used"),
+    "renders": (int(float(os.environ.get("SAAM_CACHE_RENDERS_GB", 2)) * GB), "least-recently-used"),
+    "catalog": (GB, "none"),
+    "presence": (GB, "none"),
+}
+
+_caches = dict()
+_caches_lock = threading.Lock()
+_invalidations = dict()
+_invalidations_lock = threading.Lock()
+_mirrors = dict()
+
+
+def get_cache(namespace):
+    """The cache of namespace, under CACHE_DIR/namespace with the size limit
+    and eviction policy of NAMESPACES. One instance per namespace and process."""
+    with _caches_lock:
+        if namespace not in _caches:
+            size_limit, eviction_policy = NAMESPACES[namespace]
+            _caches[namespace] = dc.Cache(
+                os.path.join(CACHE_DIR, namespace), disk=compression.CompressedDisk,
+                size_limit=size_limit, eviction_policy=eviction_policy)
+        return _caches[namespace]
+
+
+def columns_limit():
+    """Bytes the decoded columns of utils.columns may take: the size limit
+    of the downloads namespace less what its cache takes."""
+    return max(NAMESPACES["downloads"][0] - get_cache("downloads").volume(), 0)
+
+
+def _ms(date):
+    """Datetime (or utc milliseconds) to utc milliseconds."""
+    if isinstance(date, datetime.datetime):
+        return date.timestamp() * 1e3
+    return date
+
+
+def is_sealed(end):
+    """True if the period ending at end (datetime or ms) can not change anymore.
+    Open ended periods (end is None) are never sealed."""
+    if end is None:
+        return False
+    settled = datetime.datetime.utcnow() - SETTLE_DELAY
+    return _ms(end) <= _ms(settled)
+
+
+def set_warming(ttl, namespaces=("renders",)):
+    """Makes this process warm the caches of namespaces ahead of users, like
+    prefetch.py: cached() does not return their live entries, so they get
+    computed anew, and store() keeps them for ttl instead of LIVE_TTL, until
+    the next warming run. Other namespaces, such as the downloads shared with
+    the detail view, keep LIVE_TTL, so they are no staler than usual."""
+    global _live_ttl, _warming
+    _live_ttl = ttl
+    _warming = tuple(namespaces)
+
+
+def _warmed(cache):
+    return any(_caches.get(namespace) is cache for namespace in _warming)
+
+
+def cached(cache, key):
+    """cache.get(key), _MISSING if not there, see set_warming()."""
+    if not _warmed(cache):
+        return cache.get(key, default=_MISSING)
+    value, tag = cache.get(key, default=_MISSING, tag=True)
+    return _MISSING if tag == LIVE else value
+
+
+def store(cache, key, value, end):
+    """Stores value covering a period ending at end. Closed periods are
+    stored for good, the rest expire after LIVE_TTL (see set_warming)
+    and get downloaded anew."""
+    if is_sealed(end):
+        cache.set(key, value, tag=SEALED)
+    else:
+        ttl = _live_ttl if _warmed(cache) else LIVE_TTL
+        cache.set(key, value, expire=ttl.total_seconds(), tag=LIVE)
+
+
+def fresh_memoize(cache, end_arg="end_date", margin=datetime.timedelta(0)):
+    """Like cache.memoize(), but results are stored with store(), using
+    the argument called end_arg plus margin as the end of the covered period.
+
+    Keys are (function name, ((argument name, value), ...)) with defaults
+    applied, so positional and keyword calls share entries. The key and the
+    end of the period of a call are given by wrapper.__cache_key__(*args, **kwargs)
+    and wrapper.__cache_end__(*args, **kwargs)."""
+    def decorator(function):
+        signature = inspect.signature(function)
+        name = f"{function.__module__}.{function.__qualname__}"
+
+        def key_and_end(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = []
+            for argument, value in bound.arguments.items():
+                if signature.parameters[argument].kind is inspect.Parameter.VAR_KEYWORD:
+                    arguments.extend(sorted(value.items()))
+                else:
+                    arguments.append((argument, value))
+            end = bound.arguments.get(end_arg)
+            return (name, tuple(arguments)), end + margin if end is not None else None
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key, end = key_and_end(*args, **kwargs)
+            result = cached(cache, key)
+            if result is _MISSING:
+                logging.info(f"Not cached! Computing {key}")
+                result = function(*args, **kwargs)
+                store(cache, key, result, end)
+            return result
+
+        # Like the __cache_key__ of diskcache's memoize(), so callers can
+        # look entries up or store them themselves.
+        wrapper.__cache_key__ = lambda *args, **kwargs: key_and_end(*args, **kwargs)[0]
+        wrapper.__cache_end__ = lambda *args, **kwargs: key_and_end(*args, **kwargs)[1]
+        return wrapper
+    return decorator
+
+
+def cache_summary(cache):
+    """Returns {tag: (count, size in bytes)} of unexpired entries, where
+    tag is SEALED, LIVE or None for entries stored without a policy."""
+    rows = cache._sql(
+        "SELECT tag, COUNT(*), SUM(size) FROM Cache"
+        " WHERE expire_time IS NULL OR expire_time > ? GROUP BY tag",
+        (time.time(),)).fetchall()
+    return {tag: (count, size or 0) for tag, count, size in rows}
+
+
+def live_entries(cache, limit=50):
+    """Returns (key, seconds until refresh) of the live entries."""
+    now = time.time()
+    rows = cache._sql(
+        "SELECT key, raw, expire_time FROM Cache"
+        " WHERE tag = ? AND expire_time > ? ORDER BY expire_time LIMIT ?",
+        (LIVE, now, limit)).fetchall()
+    return [(cache._disk.get(key, raw), expire_time - now) for key, raw, expire_time in rows]
+
+
+def register_mirror(namespace, forget):
+    """Registers forget(base), dropping the in-process copy a module keeps
+    of entries of namespace (of all bases if base is None). invalidate()
+    calls it, so the copy is not served or written back afterwards."""
+    _mirrors.setdefault(namespace, []).append(forget)
+
+
+def key_scope(key):
+    """(base, loc_ids, lo_ms, hi_ms) a cache key covers, None where unknown.
+    loc_ids is a tuple. Understands the keys of fresh_memoize, whose arguments
+    are named base, loc_id or loc_ids and start_date/start and end_date/end,
+    the chunks of utils.acquire: ("download" | "accel", base, loc_id, ...,
+    chunk_ms, chunk_start[, "delta"]) and ("decoded", name, base, loc_id, ...,
+    chunk_ms, chunk_start), and the indexes ("catalog" | "presence", base, ...),
+    which only tell their base, as they are only removed a base at a time."""
+    if not isinstance(key, tuple) or not key:
+        return None, None, None, None
+    if len(key) == 2 and isinstance(key[1], tuple) and all(
+            isinstance(item, tuple) and len(item) == 2 for item in key[1]):
+        arguments = dict(key[1])
+        loc_ids = arguments.get("loc_ids", [arguments["loc_id"]] if "loc_id" in arguments else None)
+        start = arguments.get("start_date", arguments.get("start"))
+        end = arguments.get("end_date", arguments.get("end"))
+        return (arguments.get("base"), tuple(loc_ids) if loc_ids is not None else None,
+                _ms(start) if start is not None else None, _ms(end) if end is not None else None)
+    if key[0] in ("download", "accel", "decoded"):
+        chunk = key[:-1] if key[-1] == "delta" else key
+        base, loc_id = key[1:3] if key[0] != "decoded" else key[2:4]
+        return base, (loc_id,), chunk[-1], chunk[-1] + chunk[-2]
+    if key[0] in ("catalog", "presence") and len(key) > 1:
+        return key[1], None, None, None
+    return None, None, None, None
+
+
+def _matches(key, base, loc_id, lo_ms, hi_ms):
+    key_base, key_loc_ids, key_lo, key_hi = key_scope(key)
+    if base is not None and key_base != base:
+        return False
+    if loc_id is not None and (key_loc_ids is None or loc_id not in key_loc_ids):
+        return False
+    if lo_ms is not None or hi_ms is not None:
+        if key_lo is None and key_hi is None:
+            return False
+        # Open ends on either side overlap everything.
+        if lo_ms is not None and key_hi is not None and key_hi <= lo_ms:
+            return False
+        if hi_ms is not None and key_lo is not None and key_lo >= hi_ms:
+            return False
+    return True
+
+
+def invalidate(namespace, base=None, loc_id=None, start=None, end=None):
+    """Removes the entries of namespace about base, loc_id and the period
+    [start, end) (datetimes or ms), all of them if no criteria are given.
+    Entries whose keys do not tell, see key_scope(), are kept unless all
+    are removed. The decoded columns of utils.columns count as downloads.
+    Returns the number removed."""
+    cache = get_cache(namespace)
+    lo_ms = _ms(start) if start is not None else None
+    hi_ms = _ms(end) if end is not None else None
+    removed = 0
+    if namespace == "downloads":
+        removed += columns.invalidate(base, loc_id, lo_ms, hi_ms)
+    if base is None and loc_id is None and start is None and end is None:
+        removed += cache.clear(retry=True)
+    else:
+        rows = cache._sql("SELECT key, raw FROM Cache").fetchall()
+        for db_key, raw in rows:
+            key = cache._disk.get(db_key, raw)
+            if _matches(key, base, loc_id, lo_ms, hi_ms) and cache.delete(key, retry=True):
+                removed += 1
+    for forget in _mirrors.get(namespace, []):
+        forget(base)
+    return removed
+
+
+def invalidate_in_background(namespaces, **criteria):
+    """Runs invalidate() for namespaces on a thread and returns at once.
+    Progress is listed by invalidations()."""
+    def run():
+        for namespace in namespaces:
+            try:
+                removed = invalidate(namespace, **criteria)
+                logging.info(f"Removed {removed} entries of {namespace} matching {criteria}.")
+            except Exception as e:
+                logging.warning(f"Invalidating {namespace} matching {criteria} raised {e!r}")
+        with _invalidations_lock:
+            del _invalidations[thread.ident]
+
+    thread = threading.Thread(target=run, daemon=True)
+    with _invalidations_lock:
+        thread.start()
+        _invalidations[thread.ident] = (tuple(namespaces), criteria, time.time())
+    return thread
+
+
+def invalidations():
+    """(namespaces, criteria, started at) of the invalidations still running."""
+    with _invalidations_lock:
+        return list(_invalidations.values())
@@ -0,0 +1,159 @@
+import re
+import time
+import datetime
+import threading
+import logging
+from utils.connection import get_db
+from utils import caching
+
+cache = caching.get_cache("catalog")
+
+COLLECTION_PREFIX = "SensorDataPackages"
+# How long the catalog is trusted before it is refreshed incrementally.
+CATALOG_TTL = datetime.timedelta(minutes=10)
+# Incremental refreshes re-read this much history below the known maximum,
+# to pick up packets that were uploaded late.
+REFRESH_OVERLAP = datetime.timedelta(days=1)
+
+_catalogs = dict()
+_locks = {"prod": threading.Lock(), "dev": threading.Lock()}
+
+
+def _scan(collection, since_ms=None):
+    """Returns {(LocationId, SourceId): [min, max]} of Data.Timestamp
+    for packets newer than since_ms (all if None)."""
+    pipeline = [
+        {"$group": {
+            "_id": {"loc": "$LocationId", "src": "$SourceId"},
+            "min": {"$min": "$Data.Timestamp"},
+            "max": {"$max": "$Data.Timestamp"}}},
+        ]
+    if since_ms is not None:
+        pipeline.insert(0, {"$match": {"Data.Timestamp": {"$gt": since_ms}}})
+    spans = dict()
+    for item in collection.aggregate(pipeline, allowDiskUse=True):
+        if item["min"] is None:
+            continue
+        spans[(item["_id"].get("loc"), item["_id"].get("src"))] = [item["min"], item["max"]]
+    return spans
+
+
+def refresh(base="prod", max_age=None):
+    """Brings the catalog of base up to date and returns it. With max_age
+    (seconds), a catalog refreshed since then, such as by another thread
+    waiting for the lock before, is returned as it is.
+
+    The catalog is {"refreshed": epoch seconds, "collections": {name: entry}},
+    where each entry has the "min" and "max" Data.Timestamp of the collection
+    and "spans", {(LocationId, SourceId): [min, max]}. Known collections are
+    only scanned for packets newer than their maximum minus REFRESH_OVERLAP,
+    new collections are scanned whole."""
+    with _locks.setdefault(base, threading.Lock()):
+        current = _load(base)
+        if max_age is not None and time.time() - current["refreshed"] <= max_age:
+            return current
+        db = get_db(base)
+        old = current["collections"]
+        collections = dict()
+        for name in db.list_collection_names():
+            if not name.startswith(COLLECTION_PREFIX):
+                continue
+            entry = old.get(name)
+            if entry is None:
+                logging.info(f"Cataloguing collection {name} on {base}.")
+                spans = _scan(db[name])
+            else:
+                spans = dict(entry["spans"])
+                since_ms = entry["max"] - REFRESH_OVERLAP.total_seconds() * 1e3
+                for pair, (lo, hi) in _scan(db[name], since_ms).items():
+                    if pair in spans:
+                        spans[pair] = [min(lo, spans[pair][0]), max(hi, spans[pair][1])]
+                    else:
+                        spans[pair] = [lo, hi]
+            if not spans:
+                continue
+            collections[name] = {
+                "min": min(lo for lo, hi in spans.values()),
+                "max": max(hi for lo, hi in spans.values()),
+                "spans": spans}
+        catalog = {"refreshed": time.time(), "collections": collections}
+        cache.set(("catalog", base), catalog)
+        _catalogs[base] = catalog
+        return catalog
+
+
+def _load(base):
+    catalog = _catalogs.get(base)
+    if catalog is None:
+        catalog = cache.get(("catalog", base), default={"refreshed": 0, "collections": dict()})
+        _catalogs[base] = catalog
+    return catalog
+
+
+def forget(base=None):
+    """Drops the in-process copy of the catalog of base (of all bases if
+    None), so that it is read from the cache again."""
+    if base is None:
+        _catalogs.clear()
+    else:
+        _catalogs.pop(base, None)
+
+
+caching.register_mirror("catalog", forget)
+
+
+def get_catalog(base="prod"):
+    """Returns the catalog of base, refreshing it if older than CATALOG_TTL."""
+    catalog = _load(base)
+    if time.time() - catalog["refreshed"] > CATALOG_TTL.total_seconds():
+        catalog = refresh(base, max_age=CATALOG_TTL.total_seconds())
+    return catalog
+
+
+def collections_for(
+    base = "prod",
+    start_date: datetime.datetime = None,
+    end_date: datetime.datetime = None,
+    loc_id: str = None):
+    """Names of the sensor data collections that can hold packets between
+    start_date and end_date (for loc_id, if given), oldest first.
+
+    The collection with the newest data is treated as open ended, since
+    packets keep arriving there between catalog refreshes."""
+    collections = get_catalog(base)["collections"]
+    if not collections:
+        return []
+    start_ms = start_date.timestamp() * 1e3 if start_date else -float("inf")
+    end_ms = end_date.timestamp() * 1e3 if end_date else float("inf")
+    newest = max(collections, key=lambda name: collections[name]["max"])
+    names = []
+    for name, entry in sorted(collections.items(), key=lambda item: (item[1]["min"], item[0])):
+        if loc_id is None:
+            spans = [(entry["min"], entry["max"])]
+        else:
+            spans = [span for (loc, src), span in entry["spans"].items() if loc == loc_id]
+        open_ended = name == newest and end_ms > entry["max"]
+        if open_ended or any(lo < end_ms and hi > start_ms for lo, hi in spans):
+            names.append(name)
+    return names
+
+
+def expand_source(base, loc_id, collection, source_id, end_ms=None):
+    """Turns a {"$regex": pattern} SourceId filter into the equivalent
+    {"$in": [...]} of the SourceIds the catalog knows for loc_id in collection,
+    so that the query can use the SourceId index. Other filters, and regexes
+    the catalog can not vouch for (catalog older than CATALOG_TTL and window
+    ending past the catalogued data), are returned unchanged."""
+    if not (isinstance(source_id, dict) and list(source_id) == ["$regex"]
+            and isinstance(source_id["$regex"], str)):
+        return source_id
+    catalog = _load(base)
+    entry = catalog["collections"].get(collection)
+    if entry is None:
+        return source_id
+    fresh = time.time() - catalog["refreshed"] <= CATALOG_TTL.total_seconds()
+    if not fresh and (end_ms is None or end_ms > entry["max"]):
+        return source_id
+    pattern = re.compile(source_id["$regex"])
+    return {"$in": sorted(src for loc, src in entry["spans"]
+                          if loc == loc_id and src is not None and pattern.search(src))}
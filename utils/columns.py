@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+COLUMNS_DIR = os.path.join("cache", "columns")
+# Stored columns are culled after this many bytes were written by the process.
+CULL_EVERY = 256 * 1024 ** 2
+_DTYPE = np.dtype([("t", "<i8"), ("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("m", "<f4")])
+# The first save of a process culls, in case the limit was lowered.
+_written = CULL_EVERY
+_written_lock = threading.Lock()
+
+
+def _write(path, write):
+    """Writes a file through a temporary one, so readers never see half of it."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        write(f)
+    os.replace(temporary, path)
+
+
+class ColumnStore:
+    """Decoded accelerometer chunks as .npy files, one per
+    (base, loc_id, SourceId, chunk), loaded memory mapped.
+
+    Only chunks that can not change anymore belong here. A manifest per
+    (source filter, collections, chunk) lists the SourceIds the filter
+    matched, so a chunk without data is remembered as well. Series are
+    kept per collections too, as chunks read from fewer collections hold
+    fewer packets.
+
+    With size_limit, files least recently used are removed once all stored
+    columns take more bytes, see cull()."""
+    def __init__(self, base, loc_id, source_filter, chunk_ms, collections, root=COLUMNS_DIR, size_limit=None):
+        self.root = root
+        self.size_limit = size_limit
+        self.directory = os.path.join(root, base, loc_id)
+        self.chunk_ms = chunk_ms
+        self.collections_hash = hashlib.sha1(str(collections).encode()).hexdigest()[:16]
+        self.filter_hash = hashlib.sha1(str((source_filter, collections)).encode()).hexdigest()[:16]
+
+    def _series_path(self, source_id, chunk_start):
+        return os.path.join(self.directory, source_id, f"{self.collections_hash}-{self.chunk_ms}-{chunk_start}.npy")
+
+    def _manifest_path(self, chunk_start):
+        return os.path.join(self.directory, "_chunks", f"{self.filter_hash}-{self.chunk_ms}-{chunk_start}.json")
+
+    def load(self, chunk_start, default=None):
+        """Returns {SourceId: AccelSeries} of the chunk, default if not stored."""
+        from utils.acquire import AccelSeries
+        try:
+            with open(self._manifest_path(chunk_start)) as f:
+                source_ids = json.load(f)
+            value = dict()
+            for source_id in source_ids:
+                columns = np.load(self._series_path(source_id, chunk_start), mmap_mode="r")
+                value[source_id] = AccelSeries(*(columns[name] for name in _DTYPE.names))
+            # Modification times tell cull() which files were used last.
+            for path in [self._manifest_path(chunk_start)] + [self._series_path(i, chunk_start) for i in source_ids]:
+                os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return default
+
+    def save(self, chunk_start, value):
+        """Stores {SourceId: AccelSeries} of the chunk."""
+        global _written
+        value = {source_id: series for source_id, series in value.items() if len(series.t)}
+        written = 0
+        for source_id, series in value.items():
+            columns = np.empty(len(series.t), dtype=_DTYPE)
+            for name, column in zip(_DTYPE.names, series):
+                columns[name] = column
+            _write(self._series_path(source_id, chunk_start), lambda f: np.save(f, columns))
+            written += columns.nbytes
+        _write(self._manifest_path(chunk_start), lambda f: f.write(json.dumps(sorted(value)).encode()))
+        if self.size_limit is None:
+            return
+        with _written_lock:
+            _written += written
+            due = _written >= CULL_EVERY
+            if due:
+                _written = 0
+        if due:
+            cull(self.size_limit, self.root)
+
+
+def cull(size_limit, root=COLUMNS_DIR):
+    """Removes the files least recently used until the stored columns take
+    at most size_limit bytes. Chunks missing some of their files are fetched
+    anew. Returns the number of files removed."""
+    files = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= size_limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear(root=COLUMNS_DIR):
+    """Removes all stored columns."""
+    shutil.rmtree(root, ignore_errors=True)
+
+
+def invalidate(base=None, loc_id=None, lo_ms=None, hi_ms=None, root=COLUMNS_DIR):
+    """Removes the stored chunks of base and loc_id overlapping [lo_ms, hi_ms),
+    all of them where not given. Returns the number of files removed."""
+    removed = 0
+    for directory, _, files in os.walk(root):
+        parts = os.path.relpath(directory, root).split(os.sep)
+        if len(parts) < 3 or (base is not None and parts[0] != base) or (loc_id is not None and parts[1] != loc_id):
+            continue
+        for name in files:
+            try:
+                chunk_ms, chunk_start = (int(part) for part in os.path.splitext(name)[0].rsplit("-", 2)[-2:])
+            except ValueError:
+                continue
+            if (lo_ms is not None and chunk_start + chunk_ms <= lo_ms) or (hi_ms is not None and chunk_start >= hi_ms):
+                continue
+            os.remove(os.path.join(directory, name))
+            removed += 1
+    return removed
@@ -0,0 +1,139 @@
+import io
+import os
+import time
+import zlib
+import pickle
+import threading
+import numpy as np
+import diskcache as dc
+
+# Header of the values written by CompressedDisk, followed by a codec byte.
+MAGIC = b"SAAMz"
+_ZLIB = b"z"
+_STORED = b"-"
+LEVEL = int(os.environ.get("SAAM_CACHE_COMPRESSION_LEVEL", 1))
+# Shorter arrays are not worth delta encoding.
+MIN_ARRAY_SIZE = 64
+
+_stats = {"entries": 0, "raw_bytes": 0, "stored_bytes": 0, "encode_seconds": 0.0,
+          "decoded": 0, "decoded_bytes": 0, "decode_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _count(**amounts):
+    with _stats_lock:
+        for name, amount in amounts.items():
+            _stats[name] += amount
+
+
+def get_stats():
+    """Returns the compression ratio and the encode/decode throughput
+    in MB/s of this process, with the counts they come from."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["ratio"] = stats["raw_bytes"] / stats["stored_bytes"] if stats["stored_bytes"] else None
+    stats["encode_mbps"] = stats["raw_bytes"] / stats["encode_seconds"] / 1e6 if stats["encode_seconds"] else None
+    stats["decode_mbps"] = stats["decoded_bytes"] / stats["decode_seconds"] / 1e6 if stats["decode_seconds"] else None
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+def _smallest_int(values):
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= values.min() and values.max() <= info.max:
+            return values.astype(dtype)
+    return values
+
+
+def _deltas(array):
+    """(first, deltas) of a non decreasing array of whole numbers, such as
+    millisecond timestamps, None for other arrays."""
+    if array.dtype.kind == "M":
+        if np.isnat(array).any():
+            return None
+        values = array.view(np.int64)
+    elif array.dtype.kind in "iu" and array.dtype.itemsize <= 8 and array.dtype != np.uint64:
+        values = array.astype(np.int64)
+    elif array.dtype.kind == "f":
+        if not np.isfinite(array).all() or np.signbit(array).any() or array.max() >= 2 ** 53:
+            return None
+        values = array.astype(np.int64)
+        if not np.array_equal(values, array):
+            return None
+    else:
+        return None
+    if values.min() < -2 ** 62 or values.max() > 2 ** 62:
+        return None
+    deltas = np.diff(values)
+    if deltas.min() < 0:
+        return None
+    return int(values[0]), _smallest_int(deltas)
+
+
+def _undelta(dtype, first, deltas_dtype, deltas):
+    deltas = np.frombuffer(deltas, dtype=deltas_dtype)
+    values = np.concatenate([[first], first + np.cumsum(deltas, dtype=np.int64)])
+    if np.dtype(dtype).kind == "M":
+        return values.view(dtype)
+    return values.astype(dtype)
+
+
+class _Pickler(pickle.Pickler):
+    """Pickles long timestamp-like arrays as their first value and
+    deltas, in the smallest integer type holding them."""
+    def reducer_override(self, obj):
+        if (not isinstance(obj, np.ndarray) or obj.ndim != 1 or len(obj) < MIN_ARRAY_SIZE
+                or obj.dtype.kind not in "iufM"):
+            return NotImplemented
+        packed = _deltas(obj)
+        if packed is None:
+            return NotImplemented
+        first, deltas = packed
+        return _undelta, (obj.dtype.str, first, deltas.dtype.str, deltas.tobytes())
+
+
+def encode(value):
+    """value as MAGIC, codec and the compressed pickle."""
+    buffer = io.BytesIO()
+    _Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+    raw = buffer.getvalue()
+    compressed = zlib.compress(raw, LEVEL)
+    # Already compressed values, such as images, are kept as they are.
+    if len(compressed) < len(raw):
+        return MAGIC + _ZLIB + compressed, len(raw)
+    return MAGIC + _STORED + raw, len(raw)
+
+
+def decode(data):
+    codec, payload = data[len(MAGIC):len(MAGIC) + 1], data[len(MAGIC) + 1:]
+    raw = zlib.decompress(payload) if codec == _ZLIB else payload
+    return pickle.loads(raw), len(raw)
+
+
+class CompressedDisk(dc.Disk):
+    """diskcache Disk storing values as encode() does. Keys and small
+    numbers or strings are stored as by dc.Disk, and so are values read
+    from files. Entries written before are still read as they were."""
+    def store(self, value, read, key=dc.core.UNKNOWN):
+        if read or type(value) in (int, float) or (type(value) is str and len(value) < self.min_file_size):
+            return super().store(value, read, key=key)
+        started = time.perf_counter()
+        data, raw_bytes = encode(value)
+        _count(entries=1, raw_bytes=raw_bytes, stored_bytes=len(data),
+               encode_seconds=time.perf_counter() - started)
+        return super().store(data, False, key=key)
+
+    def fetch(self, mode, filename, value, read):
+        data = super().fetch(mode, filename, value, read)
+        if type(data) is not bytes or not data.startswith(MAGIC):
+            return data
+        started = time.perf_counter()
+        value, raw_bytes = decode(data)
+        _count(decoded=1, decoded_bytes=raw_bytes, decode_seconds=time.perf_counter() - started)
+        return value
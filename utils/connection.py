@@ -0,0 +1,132 @@
+import os
+import atexit
+import threading
+import logging
+from collections import Counter
+from pymongo import MongoClient
+from pymongo import monitoring
+
+# Client settings, overridable from the environment of the streamlit process.
+POOL_SIZE = int(os.environ.get("SAAM_MONGO_POOL_SIZE", 16))
+COMPRESSORS = os.environ.get("SAAM_MONGO_COMPRESSORS", "zlib")
+CONNECT_TIMEOUT_MS = int(os.environ.get("SAAM_MONGO_CONNECT_TIMEOUT_MS", 10000))
+SOCKET_TIMEOUT_MS = int(os.environ.get("SAAM_MONGO_SOCKET_TIMEOUT_MS", 120000))
+SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("SAAM_MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000))
+
+_clients = dict()
+_lock = threading.Lock()
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+class _CommandCounter(monitoring.CommandListener):
+    """Counts every command sent to the server, i.e. every round trip."""
+    def started(self, event):
+        _count("round_trips")
+        _count(f"command_{event.command_name}")
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        _count("failed_commands")
+
+
+class _PoolCounter(monitoring.ConnectionPoolListener):
+    """Counts opened connections and checkouts from the pool."""
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        _count("connections_opened")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        _count("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        _count("checkout_failures")
+
+    def connection_checked_out(self, event):
+        _count("checkouts")
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def _db_url(base):
+    # The credentials module is not published with the repository.
+    from secrets import db_url
+    return db_url
+
+
+def get_client(base="prod"):
+    """Returns the process-wide MongoClient for given base, creating it on first use.
+    The client is shared by all threads and survives streamlit reruns, since
+    the module stays imported for the lifetime of the server process."""
+    try:
+        return _clients[base]
+    except KeyError:
+        pass
+    with _lock:
+        if base not in _clients:
+            logging.info(f"Opening MongoClient for base {base}.")
+            _clients[base] = MongoClient(
+                _db_url(base),
+                maxPoolSize=POOL_SIZE,
+                compressors=COMPRESSORS,
+                connectTimeoutMS=CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=SOCKET_TIMEOUT_MS,
+                serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS,
+                event_listeners=[_CommandCounter(), _PoolCounter()],
+            )
+            _count("clients_created")
+        return _clients[base]
+
+
+def get_db(base="prod"):
+    """Returns the saam database on the shared client for given base."""
+    return get_client(base)["saam"]
+
+
+def close_clients():
+    """Closes all shared clients. Registered to run at interpreter exit."""
+    with _lock:
+        for base, client in _clients.items():
+            logging.info(f"Closing MongoClient for base {base}.")
+            client.close()
+        _clients.clear()
+
+
+atexit.register(close_clients)
+
+
+def get_stats():
+    """Returns a copy of the connection and round trip counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    """Zeroes the counters, e.g. at the start of a page render."""
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,85 @@
+import datetime
+import logging
+from collections import namedtuple
+import numpy as np
+from utils import acquire as ac
+from utils import catalog
+
+# Samples kept per SourceId, about an hour of 50 Hz data.
+CAPACITY = 200000
+POLL_INTERVAL = datetime.timedelta(seconds=5)
+# Live views stop polling after this long, in case they are left open.
+MAX_DURATION = datetime.timedelta(minutes=30)
+
+Tail = namedtuple("Tail", ["t", "m"])
+
+
+class RingBuffer:
+    """The last capacity (time, magnitude) samples appended."""
+    def __init__(self, capacity=CAPACITY):
+        self.t = np.zeros(capacity, dtype=np.int64)
+        self.m = np.zeros(capacity, dtype=np.float32)
+        self.size = 0
+        self.head = 0
+
+    def extend(self, t, m):
+        capacity = len(self.t)
+        t, m = t[-capacity:], m[-capacity:]
+        positions = (self.head + np.arange(len(t))) % capacity
+        self.t[positions] = t
+        self.m[positions] = m
+        self.head = (self.head + len(t)) % capacity
+        self.size = min(self.size + len(t), capacity)
+
+    def values(self):
+        """Tail of the samples, oldest first."""
+        order = (self.head - self.size + np.arange(self.size)) % len(self.t)
+        return Tail(self.t[order], self.m[order])
+
+
+class LiveTail:
+    """Decoded magnitudes of the packets of loc_id matching source_id
+    that arrive after it was started, one RingBuffer per SourceId.
+    Every poll only asks every SourceId for packets newer than the newest
+    Data.Timestamp seen of it, and SourceIds not seen yet for packets from
+    the oldest of those on, so memory and query cost stay the same however
+    long it runs, and SourceIds uploading later than others are not skipped."""
+    def __init__(self, loc_id, source_id, base="prod", history=datetime.timedelta(minutes=10), capacity=CAPACITY):
+        self.loc_id = loc_id
+        self.source_id = source_id
+        self.base = base
+        self.capacity = capacity
+        self.buffers = dict()
+        self.start_ms = int((datetime.datetime.utcnow() - history).timestamp() * 1e3)
+        # {SourceId: newest Data.Timestamp seen}.
+        self.newest = dict()
+
+    def poll(self):
+        """Fetches and decodes the packets newer than the newest seen.
+        Returns the number of new samples."""
+        now = datetime.datetime.utcnow()
+        after = {source_id: int(timestamp) + 1 for source_id, timestamp in self.newest.items()}
+        lo_ms = min(after.values(), default=self.start_ms)
+        # Packets can be stamped a little ahead of the server clock.
+        hi_ms = (now + POLL_INTERVAL).timestamp() * 1e3
+        start = datetime.datetime.fromtimestamp(lo_ms / 1e3)
+        collections = catalog.collections_for(self.base, start, now, self.loc_id)
+        deduplicator = ac.Deduplicator()
+        decoder = ac._stream_into(ac.MagnitudeDecoder(), self.loc_id, self.source_id, lo_ms, hi_ms, collections,
+                                  self.base, ac.SENSOR_FIELDS, ac.STREAM_BATCH_SIZE, raw=True,
+                                  deduplicator=deduplicator, after=after)
+        deduplicator.report(f"{self.loc_id} live tail")
+        result = decoder.result()
+        added = 0
+        for source_id, series in result.items():
+            buffer = self.buffers.setdefault(source_id, RingBuffer(self.capacity))
+            buffer.extend(series.t, series.m)
+            added += len(series.t)
+        for source_id, timestamp in ac.MagnitudeDecoder.newest_by_source(result).items():
+            self.newest[source_id] = max(self.newest.get(source_id, timestamp), timestamp)
+        logging.debug(f"Live tail of {self.loc_id} got {added} samples, newest at {self.newest}.")
+        return added
+
+    def snapshot(self):
+        """{SourceId: Tail} of the buffered samples."""
+        return {source_id: buffer.values() for source_id, buffer in sorted(self.buffers.items())}
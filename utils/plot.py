@@ -4,11 +4,33 @@ import matplotlib.pyplot as plt
 plt.rcParams["font.family"] = "serif"
 
 from utils import acquire as ac 
-from utils import DATA_COLLECTIONS
+from utils import caching
+import os
+import io
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 import datetime 
-import diskcache as dc
+import functools
 
-cache = dc.Cache("cache/")
+cache = caching.get_cache("renders")
+
+RENDER_FORMAT = "png"
+RENDER_DPI = 100
+# Bump whenever the drawing code changes, so stale images are not served.
+RENDER_VERSION = 1
+# Batch rendering downloads on threads and draws in worker processes,
+# RENDER_IO_WORKERS locations at a time, each with its own download jobs.
+RENDER_IO_WORKERS = int(os.environ.get("SAAM_RENDER_IO_WORKERS", 4))
+RENDER_PROCESSES = int(os.environ.get("SAAM_RENDER_PROCESSES", min(4, os.cpu_count() or 1)))
+
+# Magnitudes handed from the download to the drawing step are decimated to
+# this many columns, more than any axes is wide in pixels.
+LOAD_COLUMNS = 2048
+
+_draw_pool = None
+_draw_pool_lock = threading.Lock()
 
 # def memoize(f):
 #     global cache
@@ -26,7 +48,6 @@ cache = dc.Cache("cache/")
 #     return inner
 # @memoize
 
-@cache.memoize()
 def make_figure(loc_id, start_date, end_date, base, plot_type, **kwargs):
     if plot_type == 'plot bed sensor data':
         return plot_bed(loc_id, start_date, end_date, base, **kwargs)
@@ -40,63 +61,133 @@ def make_figure(loc_id, start_date, end_date, base, plot_type, **kwargs):
         return plot_clip_mobility(loc_id, start_date, end_date, base, **kwargs)
 
 
+def render_figure(loc_id, start_date, end_date, base, plot_type, format=RENDER_FORMAT, **kwargs):
+    """Returns the figure of make_figure as image bytes in given format,
+    cached by the plot parameters. Images of windows that are not closed
+    are stored as live entries, and so drawn anew once they expire."""
+    return _render(loc_id, start_date, end_date, base, plot_type, format, RENDER_VERSION, **kwargs)
+
+
+# Bed plots include peaks and sleep states up to a day after the window.
+@caching.fresh_memoize(cache, margin=datetime.timedelta(days=1, hours=2))
+def _render(loc_id, start_date, end_date, base, plot_type, format, version, **kwargs):
+    return figure_image(make_figure(loc_id, start_date, end_date, base, plot_type, **kwargs), format)
+
+
+def figure_image(fig, format=RENDER_FORMAT):
+    """Saves fig as bytes in given format and closes it."""
+    try:
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=format, dpi=RENDER_DPI)
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def minmax_keep(t, m, start_ms, end_ms, columns):
+    """Indices of the lowest and highest sample of each of columns equal
+    time bins between start_ms and end_ms (bins continue past them) of a time
+    sorted series, so spikes stay visible. A NaN is kept in bins that have one,
+    to keep the gaps. Series of at most 2 * columns samples are kept whole."""
+    if len(t) <= 2 * columns:
+        return slice(None)
+    width = (end_ms - start_ms) / columns
+    bins = np.floor((t - start_ms) / width).astype(np.int64)
+    starts = np.r_[0, np.flatnonzero(np.diff(bins)) + 1]
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(t)]))
+
+    def first_per_segment(hits):
+        return hits[np.r_[True, segment[hits][1:] != segment[hits][:-1]]] if len(hits) else hits
+    picks = [first_per_segment(np.flatnonzero(m == extreme[segment]))
+             for extreme in (np.fmin.reduceat(m, starts), np.fmax.reduceat(m, starts))]
+    picks.append(first_per_segment(np.flatnonzero(np.isnan(m))))
+    return np.unique(np.concatenate(picks))
+
+
+def minmax_decimate(t, m, start_ms, end_ms, columns):
+    """t and m reduced to the samples chosen by minmax_keep."""
+    keep = minmax_keep(t, m, start_ms, end_ms, columns)
+    return t[keep], m[keep]
+
+
+def _magnitudes(ax, series, start, end, decimate=True):
+    """Time and magnitude of series to plot on ax, whose visible window
+    is start to end. Decimated to about two points per pixel column,
+    unless decimate is False."""
+    if not decimate:
+        return series.t, series.m
+    return minmax_decimate(series.t, series.m, start.timestamp() * 1e3, end.timestamp() * 1e3, int(ax.bbox.width))
+
+
+def _show_errors(ax, errors):
+    """Notes the downloads that failed in the corner of the axes."""
+    if errors:
+        ax.text(0.01, 0.99, "\n".join(f"{name} download raised {e}" for name, e in errors.items()),
+                transform=ax.transAxes, va="top", fontsize=7, color="r")
+
+
+def load_bed(loc_id, start, end, base, **kwargs):
+    """Downloads what plot_bed draws: raw magnitudes, peaks and sleep states.
+    Returns (results, errors) as given by acquire.fan_out."""
+    extended_start = start - datetime.timedelta(days=1)
+    extended_end = end + datetime.timedelta(hours=2) + datetime.timedelta(days=1)
+    # Sensor raw data, peaks and sleep states are downloaded concurrently.
+    jobs = []
+    if not kwargs.get("skip_mags", False):
+        jobs.append(("accel", functools.partial(ac.download_accel, loc_id, {"$regex":"sens_bed_accel_"}, start, end + datetime.timedelta(hours=2), base=base)))
+    jobs.append(("peaks", functools.partial(ac.download_decoded, ac.PeakDecoder, loc_id, "feat_bed_accel_magnitude_peaks", extended_start, extended_end, base=base, collections=["CoachingAdditionalDataSources"])))
+    jobs.append(("sleep states", functools.partial(ac.download_decoded, ac.StateDecoder, loc_id, "feat_sleep_state", extended_start, extended_end, base=base, collections=["CoachingAdditionalDataSources"])))
+    results, errors = ac.fan_out(jobs)
+    if "accel" in results:
+        series, accel_errors = results["accel"]
+        errors.update(accel_errors)
+        if kwargs.get("decimate", True):
+            for source_id, s in series.items():
+                keep = minmax_keep(s.t, s.m, start.timestamp() * 1e3, end.timestamp() * 1e3, LOAD_COLUMNS)
+                series[source_id] = ac.AccelSeries(*(column[keep] for column in s))
+        results["accel"] = series
+    return results, errors
+
+
 def plot_bed(loc_id, start, end, base, **kwargs):
+    return draw_bed(loc_id, start, end, base, load_bed(loc_id, start, end, base, **kwargs), **kwargs)
+
+
+def draw_bed(loc_id, start, end, base, data, **kwargs):
+    results, errors = data
     fig, ax = plt.subplots(figsize=(8, 5), dpi=100)
     ax.set_xlim((start, end))
-    end = end + datetime.timedelta(hours=2)
-    # Sensor raw data acquisition
+    series = results.get("accel", dict())
+    _show_errors(ax, errors)
 
     if not kwargs.get("skip_mags", False):
-        payload = list()
-        for collection in DATA_COLLECTIONS:
-            payload += ac.download(loc_id, {"$regex":"sens_bed_accel_"}, start, end, base=base, collection=collection)
-        # payload = ac.download(loc_id, {"$regex":"sens_bed_accel_"}, start, end, base=base)
-        # payload += ac.download(loc_id, {"$regex":"sens_bed_accel_"}, start, end, base=base, )
         for suffix in ["egw", "amb", "app"]:
-            cur_payload = [item for item in payload if item["SourceId"]==f'sens_bed_accel_{suffix}']
-            if cur_payload == []:
+            if f'sens_bed_accel_{suffix}' not in series:
                 print(f"No data for {suffix}.")
                 continue
-            t, m = ac.magnitude_response_to_data(cur_payload)
+            t, m = _magnitudes(ax, series[f'sens_bed_accel_{suffix}'], start, end, kwargs.get("decimate", True))
             ax.plot(pd.to_datetime(t, unit="ms"), m, label=suffix)
     # Peak plotting:
-    extended_start = start - datetime.timedelta(days=1)
-    extended_end = end + datetime.timedelta(days=1)
-    pks = ac.download(loc_id, "feat_bed_accel_magnitude_peaks", extended_start, extended_end, collection="CoachingAdditionalDataSources", base=base)
-    if pks:
-        ls, ss = ac.peak_handler(pks)
+    times, kinds = results.get("peaks", (np.empty(0), np.empty(0)))
+    if len(times):
+        ls = times[kinds == ac.PEAK_KINDS.index("L")]
+        ss = times[kinds == ac.PEAK_KINDS.index("S")]
         ax.vlines(pd.to_datetime(ls, unit="s"), 0, 2, label="Large peaks", colors="r", linestyles="dashed", zorder=1)
         ax.vlines(pd.to_datetime(ss, unit="s"), 0.5, 1.5, label="Small peaks", colors="g", linestyles="dotted", zorder=1)
     else:
         ax.text(start, 0.7, "No peak data available")
         ax.set_ylim((0,2))
-    sleep_state = ac.download(loc_id, "feat_sleep_state", extended_start, extended_end, collection="CoachingAdditionalDataSources", base=base)
-    if sleep_state:
-        outs, ins, sleeps = ac.state_handler(sleep_state)
-        for i, item in enumerate(outs):
-            item = pd.to_datetime([*item], unit="s")
-            if i==0:
-                ax.hlines(0.5, item[0], item[1],
-                      lw=10, colors="k", label="Out of bed")
-            else:
-                ax.hlines(0.5, item[0], item[1],
-                      lw=10, colors="k")
-        for i, item in enumerate(ins):
-            item = pd.to_datetime([*item], unit="s")
-            if i==0:
-                ax.hlines(0.5, item[0], item[1],
-                      lw=10, colors="r", label="In bed")
-            else:
-                ax.hlines(0.5, item[0], item[1],
-                      lw=10, colors="r",)
-        for i, item in enumerate(sleeps):
-            item = pd.to_datetime([*item], unit="s")
-            if i==0:
-                ax.hlines(0.5, item[0], item[1],
-                      lw=10, colors="tab:orange", label="Sleeping")
-            else:
-                ax.hlines(0.5, item[0], item[1],
-                      lw=10, colors="tab:orange",)
+    starts, ends, codes = results.get("sleep states", (np.empty(0), np.empty(0), np.empty(0)))
+    if len(starts):
+        # All intervals of a state are drawn with a single call.
+        for state, color, label in [("out_of_bed", "k", "Out of bed"),
+                                    ("in_bed", "r", "In bed"),
+                                    ("sleeping", "tab:orange", "Sleeping")]:
+            chosen = codes == ac.SLEEP_STATES.index(state)
+            if not chosen.any():
+                continue
+            ax.hlines(0.5, pd.to_datetime(starts[chosen], unit="s"), pd.to_datetime(ends[chosen], unit="s"),
+                      lw=10, colors=color, label=label)
     else:
         ax.text(start, 0.5, "No sleep state available")
     
@@ -111,14 +202,7 @@ def plot_bed(loc_id, start, end, base, **kwargs):
 
 
 
-def plot_status(loc_id, start_date, end_date, base, **kwargs):
-    from .acquire import check_source_presence#_2 as check_source_presence
-    fig, ax = plt.subplots(figsize=(8, 5), dpi=100)
-    if "freq" not in kwargs.keys():
-        freq = "1h"
-    else:
-        freq = kwargs["freq"]
-    feature_list = ["sens_bed_accel_amb",
+PRESENCE_SOURCES = ["sens_bed_accel_amb",
                     "sens_bed_accel_egw",
                     #"sens_bed_accel_app"
                     "sens_uwb_activity",
@@ -129,14 +213,55 @@ def plot_status(loc_id, start_date, end_date, base, **kwargs):
                                                         'app',
                                                         'egw']],
                     ]
-    for i, source_id in enumerate(feature_list):
-        timerange, is_data = check_source_presence(
-                        loc_id, 
-                        source_id,
-                        start_date, 
-                        end_date, 
-                        base = base,
-                        freq = freq)
+
+
+def load_status(loc_id, start_date, end_date, base, **kwargs):
+    """Checks the presence of each of PRESENCE_SOURCES, concurrently.
+    Returns ({source_id: (timerange, is_data)}, errors)."""
+    jobs = [(source_id, functools.partial(ac.check_source_presence, loc_id, source_id, start_date, end_date,
+                                          base=base, freq=kwargs.get("freq", "1h")))
+            for source_id in PRESENCE_SOURCES]
+    return ac.fan_out(jobs)
+
+
+def split_fleet(presence):
+    """Turns acquire.FleetPresence into {loc_id: data for draw_status}."""
+    return {loc_id: ({source_id: (presence.timerange, presence.is_data[i, j])
+                      for j, source_id in enumerate(presence.source_ids)}, dict())
+            for i, loc_id in enumerate(presence.loc_ids)}
+
+
+def draw_fleet(presence, base):
+    """Heatmap of how many of the sources of acquire.FleetPresence
+    have data, per location and period."""
+    loc_ids, source_ids = presence.loc_ids, presence.source_ids
+    fig, ax = plt.subplots(figsize=(8, max(3, 1.5 + 0.25 * len(loc_ids))), dpi=100)
+    mesh = ax.pcolormesh(presence.timerange[:presence.is_data.shape[2] + 1], np.arange(len(loc_ids) + 1),
+                         presence.is_data.sum(axis=1), cmap="viridis", vmin=0, vmax=len(source_ids))
+    fig.colorbar(mesh, ax=ax, label=f"Sources with data (of {len(source_ids)})")
+    ax.set_yticks(np.arange(len(loc_ids)) + 0.5)
+    ax.set_yticklabels(loc_ids)
+    ax.invert_yaxis()
+    ax.set_title(f"Sensor data presence, {base} database")
+    ax.set_xlabel("Datetime (UTC)")
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    return fig
+
+
+def plot_status(loc_id, start_date, end_date, base, **kwargs):
+    return draw_status(loc_id, start_date, end_date, base, load_status(loc_id, start_date, end_date, base, **kwargs), **kwargs)
+
+
+def draw_status(loc_id, start_date, end_date, base, data, **kwargs):
+    presence, errors = data
+    fig, ax = plt.subplots(figsize=(8, 5), dpi=100)
+    freq = kwargs.get("freq", "1h")
+    _show_errors(ax, errors)
+    for i, source_id in enumerate(PRESENCE_SOURCES):
+        if source_id not in presence:
+            continue
+        timerange, is_data = presence[source_id]
         jitter_factor = 0.05 # This shifts the points a bit to prevent overlap
         jitter = i * jitter_factor
         ax.scatter(timerange[:len(is_data)],
@@ -145,7 +270,6 @@ def plot_status(loc_id, start_date, end_date, base, **kwargs):
                     alpha=1,
                     s = 4,
                     )
-        #breakpoint()
     ax.legend(loc="center right",  ncol=2)
     # ax.set_ylim((-0.1, 1.1))
     ax.set_xlim((start_date, end_date))
@@ -206,15 +330,13 @@ def plot_clip(loc_id, start, end, base, **kwargs):
     fig, ax = plt.subplots(figsize=(8, 5), dpi=100)
 
     try:
-        payload = list()
-        for collection in DATA_COLLECTIONS:
-            payload += ac.download(
-                loc_id,
-                {"$regex": "_accel_"},
-                start,
-                end + datetime.timedelta(hours=2),
-                base=base,
-                collection=collection)
+        series, errors = ac.download_accel(
+            loc_id,
+            {"$regex": "_accel_"},
+            start,
+            end + datetime.timedelta(hours=2),
+            base=base)
+        _show_errors(ax, errors)
         for placement in ["bed",
                           "belt",
                           "bracelet_right",
@@ -222,10 +344,9 @@ def plot_clip(loc_id, start, end, base, **kwargs):
                           "ankle",
                           "bracelet_right "]:
             for suffix in ["egw", "amb", "app"]:
-                founds = [item for item in payload if item["SourceId"] == f"sens_{placement}_accel_{suffix}"]
-                if founds == []:
+                if f"sens_{placement}_accel_{suffix}" not in series:
                     continue
-                t, m = ac.magnitude_response_to_data(founds)
+                t, m = _magnitudes(ax, series[f"sens_{placement}_accel_{suffix}"], start, end, kwargs.get("decimate", True))
                 ax.plot(
                     pd.to_datetime(t, unit="ms"),
                     m,
@@ -248,25 +369,22 @@ def plot_clip_mobility(loc_id, start, end, base, **kwargs):
     fig, [ax, ax2] = plt.subplots(figsize=(8, 5), dpi=100, nrows=2, sharex=True)
 
     try:
-        payload = list()
-        for collection in DATA_COLLECTIONS:
-            payload += ac.download(
-                loc_id,
-                {"$regex": "_accel_"},
-                start,
-                end + datetime.timedelta(hours=2, minutes=5),
-                base=base,
-                collection=collection)
+        series, errors = ac.download_accel(
+            loc_id,
+            {"$regex": "_accel_"},
+            start,
+            end + datetime.timedelta(hours=2, minutes=5),
+            base=base)
+        _show_errors(ax, errors)
         for placement in ["belt",
                           "bracelet_right",
                           "bracelet_left",
                           "ankle",
                           "bracelet_right "]:
             for suffix in ["egw", "amb", "app"]:
-                founds = [item for item in payload if item["SourceId"] == f"sens_{placement}_accel_{suffix}"]
-                if founds == []:
+                if f"sens_{placement}_accel_{suffix}" not in series:
                     continue
-                t, m = ac.magnitude_response_to_data(founds)
+                t, m = _magnitudes(ax, series[f"sens_{placement}_accel_{suffix}"], start, end, kwargs.get("decimate", True))
                 ax.plot(
                     pd.to_datetime(t, unit="ms"),
                     m,
@@ -341,25 +459,21 @@ def plot_cooking(loc_id, start, end, base, **kwargs):
         colors = [assign_color(item) for item in completions]
         return pd.to_datetime(timestamps, unit="s"), coaching_actions, facwa, completions, colors
 
-    def _parse_cooking_data(data_list: list):
-        datetimes = pd.to_datetime([item.get("Data").get('Timestamp') for item in data_list], unit="ms")
-        try:
-            values = [item.get("Data").get('Measurements')[0].get("dP") for item in data_list]
-        except:
-            values = [item.get("Data").get('Measurements')[0] for item in data_list]
-        return datetimes, values 
-
     extended_start = start - datetime.timedelta(days=1)
     extended_end = end + datetime.timedelta(days=1)
     ax.set_xlim((start, end))
 
 
     # Deal with sensor data
-    cooking_data_dict = ac.download_cooking_data(loc_id, start, end, base)
+    try:
+        cooking_data_dict = ac.download_decoded(ac.CookingDecoder, loc_id, {"$regex": "_power_"}, start, end, base=base)
+    except Exception as e:
+        cooking_data_dict = dict()
+        _show_errors(ax, {"Power meter": e})
 
 
-    for feature, data in cooking_data_dict.items():
-        datetimes, values = _parse_cooking_data(data)
+    for feature, (timestamps, values) in cooking_data_dict.items():
+        datetimes = pd.to_datetime(timestamps, unit="ms")
         if not values:
             continue
         ax.scatter(datetimes, values, label=feature)
@@ -410,6 +524,43 @@ def plot_cooking(loc_id, start, end, base, **kwargs):
     fig.autofmt_xdate()
     return fig
 
+class LivePlot:
+    """Magnitudes of a live.LiveTail, redrawn in place: the figure and one
+    line per SourceId are kept, only their data changes between updates."""
+    def __init__(self, tail, title):
+        self.tail = tail
+        self.fig, self.ax = plt.subplots(figsize=(8, 5), dpi=100)
+        self.ax.set_title(title)
+        self.ax.set_ylabel("Magnitude (g)")
+        self.ax.set_xlabel("Datetime (UTC)")
+        self.lines = dict()
+
+    def update(self):
+        """Redraws with the current samples of the tail, returns PNG bytes."""
+        snapshot = self.tail.snapshot()
+        lo = min((series.t[0] for series in snapshot.values() if len(series.t)), default=None)
+        hi = max((series.t[-1] for series in snapshot.values() if len(series.t)), default=None)
+        for source_id, series in snapshot.items():
+            if source_id not in self.lines:
+                self.lines[source_id], = self.ax.plot([], [], label=source_id.replace("_", " "))
+                self.ax.legend(loc="upper left")
+            if hi is not None and hi > lo:
+                t, m = minmax_decimate(series.t, series.m, lo, hi, int(self.ax.bbox.width))
+            else:
+                t, m = series.t, series.m
+            self.lines[source_id].set_data(pd.to_datetime(t, unit="ms"), m)
+        if hi is not None:
+            self.ax.relim()
+            self.ax.autoscale_view()
+        self.fig.autofmt_xdate()
+        buffer = io.BytesIO()
+        self.fig.savefig(buffer, format="png", dpi=RENDER_DPI)
+        return buffer.getvalue()
+
+    def close(self):
+        plt.close(self.fig)
+
+
 def plot_sleep_coaching(loc_id, start, end, base="prod"):
     fig, ax = plt.subplots(figsize = (10, 5))
     ax.set_title(f"Sleep coaching evaluation,\n{loc_id}, {base} database")
@@ -454,4 +605,73 @@ def plot_sleep_coaching(loc_id, start, end, base="prod"):
     
     fig.autofmt_xdate()
     #plt.tight_layout()
-    return fig
\ No newline at end of file
+    return fig
+
+
+# Plot types split into a download and a drawing step, for render_many.
+SPLIT_PLOTS = {
+    'plot bed sensor data': (load_bed, draw_bed),
+    'check data presence': (load_status, draw_status),
+}
+
+
+def _draw_image(plot_type, loc_id, start_date, end_date, base, data, format, kwargs):
+    draw = SPLIT_PLOTS[plot_type][1]
+    return figure_image(draw(loc_id, start_date, end_date, base, data, **kwargs), format)
+
+
+def _get_draw_pool():
+    """The process pool drawing for render_many, started on first use.
+    Processes are spawned, since forking a threaded process is unsafe."""
+    global _draw_pool
+    with _draw_pool_lock:
+        if _draw_pool is None:
+            _draw_pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return _draw_pool
+
+
+def render_many(loc_ids, start_date, end_date, base, plot_type, format=RENDER_FORMAT,
+                io_workers=RENDER_IO_WORKERS, data=None, **kwargs):
+    """render_figure for each of loc_ids, concurrently. Downloads run on
+    io_workers threads, drawing of SPLIT_PLOTS on the RENDER_PROCESSES
+    worker processes (in the threads if RENDER_PROCESSES is 0, and together
+    with the download for other plot types).
+
+    data can map loc_ids to what the download step of SPLIT_PLOTS would
+    return, e.g. from split_fleet, to skip that download.
+
+    Yields (loc_id, image bytes or the exception raised) in the order of
+    loc_ids, each as soon as it is done."""
+    def prepare(loc_id):
+        arguments = (loc_id, start_date, end_date, base, plot_type, format, RENDER_VERSION)
+        if plot_type not in SPLIT_PLOTS:
+            return None, None, _render(*arguments, **kwargs)
+        key = _render.__cache_key__(*arguments, **kwargs)
+        image = caching.cached(cache, key)
+        if image is caching._MISSING:
+            if data is not None and loc_id in data:
+                loaded = data[loc_id]
+            else:
+                loaded = SPLIT_PLOTS[plot_type][0](loc_id, start_date, end_date, base, **kwargs)
+            drawing = (loc_id, start_date, end_date, base, loaded, format, kwargs)
+            if RENDER_PROCESSES > 0:
+                image = _get_draw_pool().submit(_draw_image, plot_type, *drawing)
+            else:
+                image = _draw_image(plot_type, *drawing)
+            return key, _render.__cache_end__(*arguments, **kwargs), image
+        return None, None, image
+
+    with ThreadPoolExecutor(max_workers=max(1, io_workers)) as executor:
+        futures = [executor.submit(prepare, loc_id) for loc_id in loc_ids]
+        for loc_id, future in zip(loc_ids, futures):
+            try:
+                key, end, image = future.result()
+                if isinstance(image, Future):
+                    image = image.result()
+                if key is not None:
+                    caching.store(cache, key, image, end)
+            except Exception as e:
+                logging.warning(f"Rendering {plot_type} for {loc_id} raised {e!r}")
+                image = e
+            yield loc_id, image
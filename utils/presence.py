@@ -0,0 +1,156 @@
+import re
+import time
+import threading
+import logging
+import numpy as np
+from utils.connection import get_db
+from utils import caching
+from utils import catalog
+
+cache = caching.get_cache("presence")
+
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+# The index is brought up to date at most this often for windows that are not closed.
+INDEX_TTL = caching.LIVE_TTL
+
+_locks = {"prod": threading.Lock(), "dev": threading.Lock()}
+
+
+def _scan(collection, since_ms=None):
+    """Yields (LocationId, SourceId, slots, max Data.Timestamp) per hour with
+    packets newer than since_ms (all if None). Slot 2 * m stands for packets
+    within utc minute m (since the epoch), slot 2 * m + 1 for packets exactly
+    at its start, which check_source_presence counts only inside a period."""
+    minute = {"$floor": {"$divide": ["$ts", MINUTE_MS]}}
+    pipeline = [
+        {"$project": {"_id": 0, "loc": "$LocationId", "src": "$SourceId", "ts": "$Data.Timestamp"}},
+        {"$group": {
+            "_id": {"loc": "$loc", "src": "$src", "hour": {"$floor": {"$divide": ["$ts", HOUR_MS]}}},
+            "slots": {"$addToSet": {"$add": [
+                {"$multiply": [minute, 2]},
+                {"$cond": [{"$eq": [{"$mod": ["$ts", MINUTE_MS]}, 0]}, 1, 0]}]}},
+            "max": {"$max": "$ts"}}},
+        ]
+    if since_ms is not None:
+        pipeline.insert(0, {"$match": {"Data.Timestamp": {"$gt": since_ms}}})
+    for item in collection.aggregate(pipeline, allowDiskUse=True):
+        key = item["_id"]
+        if key.get("hour") is None or not isinstance(key.get("src"), str):
+            continue
+        yield key.get("loc"), key["src"], [int(slot) for slot in item["slots"]], item["max"]
+
+
+def _set_slots(bitmap, slots):
+    """Returns the (origin slot, packed bits) bitmap with slots set.
+    The origin is a multiple of 8, so that the bitmap can grow by whole bytes."""
+    lo = min(slots) // 8 * 8
+    if bitmap is None:
+        origin, bits = lo, np.zeros(0, dtype=bool)
+    else:
+        origin, packed = bitmap
+        bits = np.unpackbits(packed).astype(bool)
+        if lo < origin:
+            bits = np.concatenate([np.zeros(origin - lo, dtype=bool), bits])
+            origin = lo
+    slots = np.asarray(slots, dtype=np.int64) - origin
+    if slots.max() >= len(bits):
+        bits = np.concatenate([bits, np.zeros(slots.max() + 1 - len(bits), dtype=bool)])
+    bits[slots] = True
+    return origin, np.packbits(bits)
+
+
+def _meta(base):
+    return cache.get(("presence", base), default={"refreshed": 0, "collections": dict()})
+
+
+def refresh(base="prod", max_age=None):
+    """Brings the presence index of base up to date and returns its metadata,
+    {"refreshed": epoch seconds, "collections": {name: newest Data.Timestamp}}.
+    With max_age (seconds), an index refreshed since then, such as by another
+    thread waiting for the lock before, is left as it is.
+
+    The index holds a bitmap of the slots of _scan per (base, LocationId, SourceId) and the
+    SourceIds known per (base, LocationId). Known collections are only scanned
+    for packets newer than their newest indexed one minus catalog.REFRESH_OVERLAP,
+    new collections are scanned whole. Bits are only ever set, so rescanning
+    is harmless."""
+    with _locks.setdefault(base, threading.Lock()):
+        meta = _meta(base)
+        if max_age is not None and time.time() - meta["refreshed"] <= max_age:
+            return meta
+        db = get_db(base)
+        collections = dict(meta["collections"])
+        slots = dict()
+        for name in catalog.get_catalog(base)["collections"]:
+            since_ms = collections.get(name)
+            if since_ms is None:
+                logging.info(f"Indexing presence in collection {name} on {base}.")
+            else:
+                since_ms -= catalog.REFRESH_OVERLAP.total_seconds() * 1e3
+            for loc_id, source_id, found, newest in _scan(db[name], since_ms):
+                collections[name] = max(collections.get(name, newest), newest)
+                slots.setdefault((loc_id, source_id), []).extend(found)
+        sources = dict()
+        for (loc_id, source_id), found in slots.items():
+            key = ("presence", base, loc_id, source_id)
+            cache.set(key, _set_slots(cache.get(key), found))
+            sources.setdefault(loc_id, set()).add(source_id)
+        for loc_id, found in sources.items():
+            key = ("presence", base, loc_id)
+            cache.set(key, sorted(found | set(cache.get(key, default=[]))))
+        meta = {"refreshed": time.time(), "collections": collections}
+        cache.set(("presence", base), meta)
+        return meta
+
+
+def lookup(loc_id, source_id, timerange, base="prod"):
+    """is_data of check_source_presence for {"$regex": source_id}, answered
+    from the index. Returns None if the periods of timerange are not whole
+    minutes. The index is refreshed first if the window is not covered by it
+    yet and it is older than INDEX_TTL; None as well if that fails, so the
+    caller can fall back to querying the collections.
+
+    The first refresh scans all history, which can outlast the socket
+    timeout of a user's request, so the index should be built beforehand
+    by prefetch.py (view "presence") or offline with refresh(base)."""
+    origin_ms = int(round(timerange[0].timestamp() * 1000))
+    freq_ms = int(round((timerange[1] - timerange[0]).total_seconds() * 1000))
+    if origin_ms % MINUTE_MS or freq_ms % MINUTE_MS:
+        return None
+    end_ms = timerange[-1].timestamp() * 1000
+    meta = _meta(base)
+    covered_ms = (meta["refreshed"] - caching.SETTLE_DELAY.total_seconds()) * 1e3
+    if end_ms > covered_ms and time.time() - meta["refreshed"] > INDEX_TTL.total_seconds():
+        try:
+            refresh(base, max_age=INDEX_TTL.total_seconds())
+        except Exception as e:
+            logging.warning(f"Refreshing the presence index of {base} raised {e!r}, querying instead.")
+            return None
+
+    periods = len(timerange) - 1
+    first, width = 2 * (origin_ms // MINUTE_MS), 2 * (freq_ms // MINUTE_MS)
+    bits = np.zeros(periods * width, dtype=bool)
+    pattern = re.compile(source_id)
+    for source in cache.get(("presence", base, loc_id), default=[]):
+        if not pattern.search(source):
+            continue
+        origin, packed = cache.get(("presence", base, loc_id, source))
+        # Overlap of the bitmap with the slots of the window.
+        lo = max(first, origin)
+        hi = min(first + len(bits), origin + 8 * len(packed))
+        if lo < hi:
+            # Only the bytes holding the overlap are unpacked.
+            skip = (lo - origin) // 8
+            unpacked = np.unpackbits(packed[skip:(hi - origin + 7) // 8])
+            bits[lo - first:hi - first] |= unpacked[lo - origin - 8 * skip:hi - origin - 8 * skip].astype(bool)
+    slots = bits.reshape(periods, width // 2, 2)
+    # Packets at the start of the first minute of a period are on its boundary.
+    return slots[:, :, 0].any(axis=1) | slots[:, 1:, 1].any(axis=1)
+
+
+def clear(base=None):
+    """Drops the index of base, or of all bases."""
+    for key in list(cache.iterkeys()):
+        if isinstance(key, tuple) and key[:1] == ("presence",) and (base is None or key[1] == base):
+            cache.delete(key)
@@ -0,0 +1,135 @@
+import struct
+import numpy as np
+import bson
+
+# Sizes of the BSON element values that have a fixed size, by type byte.
+_FIXED_SIZES = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0,
+                0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0, 0xFF: 0}
+_NUMBERS = {0x01: "<d", 0x10: "<i", 0x12: "<q"}
+
+# A measurement as the sensors write it, {"x": double, "y": double, "z": double}:
+# document size, then three double elements, then the terminating zero.
+_MEASUREMENT_SIZE = 38
+_TEMPLATE = np.zeros(_MEASUREMENT_SIZE, dtype=np.uint8)
+_TEMPLATE_MASK = np.ones(_MEASUREMENT_SIZE, dtype=bool)
+_TEMPLATE[0] = _MEASUREMENT_SIZE
+for _offset, _name in zip((4, 15, 26), b"xyz"):
+    _TEMPLATE[_offset:_offset + 3] = (0x01, _name, 0x00)
+    _TEMPLATE_MASK[_offset + 3:_offset + 11] = False
+_AXIS_OFFSETS = (7, 18, 29)
+# Array elements are keyed "0", "1", ..., so the offset of the i-th
+# measurement in an array of such measurements is known in advance.
+_MAX_MEASUREMENTS = 100000
+_ELEMENT_ENDS = np.cumsum([2 + len(str(i)) + _MEASUREMENT_SIZE for i in range(_MAX_MEASUREMENTS)])
+_DOCUMENT_STARTS = _ELEMENT_ENDS - _MEASUREMENT_SIZE
+_KEY_LENGTHS = np.array([len(str(i)) for i in range(_MAX_MEASUREMENTS)])
+
+
+def elements(buffer, start=0):
+    """{name: (type byte, value offset)} of the elements of the BSON document
+    at start of buffer, None if it holds types this reader does not know."""
+    end = start + int.from_bytes(buffer[start:start + 4], "little")
+    i = start + 4
+    found = dict()
+    while i < end - 1:
+        kind = buffer[i]
+        name_end = buffer.index(b"\x00", i + 1)
+        value = name_end + 1
+        if kind in (0x03, 0x04):
+            size = int.from_bytes(buffer[value:value + 4], "little")
+        elif kind in (0x02, 0x0D, 0x0E):
+            size = 4 + int.from_bytes(buffer[value:value + 4], "little")
+        elif kind == 0x05:
+            size = 5 + int.from_bytes(buffer[value:value + 4], "little")
+        elif kind in _FIXED_SIZES:
+            size = _FIXED_SIZES[kind]
+        else:
+            return None
+        found[buffer[i + 1:name_end].decode()] = (kind, value)
+        i = value + size
+    return found
+
+
+def _number(buffer, element):
+    if element is None or element[0] not in _NUMBERS:
+        return None
+    return struct.unpack_from(_NUMBERS[element[0]], buffer, element[1])[0]
+
+
+def _string(buffer, element):
+    if element is None or element[0] != 0x02:
+        return None
+    kind, value = element
+    return buffer[value + 4:value + 4 + int.from_bytes(buffer[value:value + 4], "little") - 1].decode()
+
+
+def packet_header(raw):
+    """(SourceId, Data.Timestamp, Data.Timestep, (offset, size) of the
+    Data.Measurements array) of a raw sensor packet, None where missing."""
+    top = elements(raw) or dict()
+    data = top.get("Data")
+    inner = elements(raw, data[1]) if data is not None and data[0] == 0x03 else None
+    inner = inner or dict()
+    measurements = inner.get("Measurements")
+    if measurements is not None and measurements[0] == 0x04:
+        offset = measurements[1]
+        measurements = (offset, int.from_bytes(raw[offset:offset + 4], "little"))
+    else:
+        measurements = None
+    return (_string(raw, top.get("SourceId")), _number(raw, inner.get("Timestamp")),
+            _number(raw, inner.get("Timestep")), measurements)
+
+
+def _count(size):
+    """Number of measurements of the usual layout in an array of given size,
+    None if the size does not fit that layout."""
+    content = size - 5
+    if content == 0:
+        return 0
+    i = int(np.searchsorted(_ELEMENT_ENDS, content))
+    if i < _MAX_MEASUREMENTS and _ELEMENT_ENDS[i] == content:
+        return i + 1
+    return None
+
+
+def accel_columns(raws):
+    """Reads raw sensor packets into (lengths, stops, timesteps, x, y, z)
+    columns like decode_accel does, and returns them with the indices of
+    the packets it could not read so (other measurement layouts), which
+    need decoding. Measurements are gathered for all packets at once."""
+    packets, stops, timesteps, offsets, counts, fallback = [], [], [], [], [], []
+    position = 0
+    for i, raw in enumerate(raws):
+        source_id, stop, timestep, measurements = packet_header(raw)
+        count = _count(measurements[1]) if measurements is not None else None
+        if stop is None or timestep is None or count is None:
+            fallback.append(i)
+        else:
+            packets.append(i)
+            stops.append(stop)
+            timesteps.append(timestep)
+            offsets.append(position + measurements[0] + 4)
+            counts.append(count)
+        position += len(raw)
+
+    buffer = np.frombuffer(b"".join(raws), dtype=np.uint8)
+    counts = np.asarray(counts, dtype=np.int64)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.asarray(offsets, dtype=np.int64)[owner] + _DOCUMENT_STARTS[within]
+    blocks = buffer[starts[:, None] + np.arange(_MEASUREMENT_SIZE)]
+    good = np.all(blocks[:, _TEMPLATE_MASK] == _TEMPLATE[_TEMPLATE_MASK], axis=1)
+    # The elements of the array must be embedded documents.
+    good &= buffer[starts - 2 - _KEY_LENGTHS[within]] == 0x03
+    read = np.ones(len(counts), dtype=bool)
+    read[owner[~good]] = False
+    fallback.extend(np.asarray(packets, dtype=np.int64)[~read].tolist())
+    blocks = blocks[read[owner]]
+    axes = [np.ascontiguousarray(blocks[:, offset:offset + 8]).view("<f8").ravel() for offset in _AXIS_OFFSETS]
+    return (counts[read], np.asarray(stops, dtype=np.float64)[read],
+            np.asarray(timesteps, dtype=np.float64)[read], *axes), sorted(fallback)
+
+
+def decode(raw):
+    """The raw packet as dicts and lists."""
+    return bson.decode(raw)
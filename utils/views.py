@@ -0,0 +1,40 @@
+import datetime
+from utils import all_loc_ids
+
+# Location prefixes offered by the "last day" and "data presence" modes.
+PREFIXES = ("AT", "BG", "SI")
+PRESENCE_FREQ = "3h"
+PRESENCE_DAYS = 5
+
+
+def _this_hour(now=None):
+    now = now or datetime.datetime.utcnow()
+    return datetime.datetime(now.year, now.month, now.day, now.hour)
+
+
+def locations(prefix):
+    """Location IDs starting with prefix."""
+    return [l for l in all_loc_ids if l.startswith(prefix)]
+
+
+def last_day(now=None):
+    """(start, end) of the "last day" mode: the 24 hours up to the current utc hour."""
+    end = _this_hour(now)
+    return end - datetime.timedelta(days=1), end
+
+
+def last_week(now=None):
+    """(start, end) of each day of the "last week" mode, noon to noon
+    (local date), oldest first."""
+    today = (now or datetime.datetime.now()).date()
+    today = datetime.datetime(today.year, today.month, today.day, 12)
+    start_date = today - datetime.timedelta(6)
+    timerange = [start_date + datetime.timedelta(i) for i in range(7)]
+    return list(zip(timerange[0:-1], timerange[1:]))
+
+
+def data_presence(now=None):
+    """(start, end) of the "data presence" mode: PRESENCE_DAYS days up to
+    the current utc hour."""
+    end = _this_hour(now)
+    return end - datetime.timedelta(days=PRESENCE_DAYS), end